@@ -0,0 +1,444 @@
+"""離線效能基準測試：以本機假的 Spotify API 量測分析流程
+
+不需要 Spotify 帳號。假 API 透過 httpx.MockTransport 接在共用 client 上，
+提供 1k / 10k / 50k 首歌的合成收藏庫，可設定延遲、429 注入與藝人重疊程度。
+每個收藏庫大小在獨立子程序中執行，讓 peak RSS 互不影響。
+
+量測項目：
+  - fetch_user_saved_tracks      分頁抓取收藏歌曲
+  - fetch_artists_genres         藝人 genre（冷快取 / 熱快取）
+  - map_genre_to_bucket          genre 分類（冷 memo / 熱 memo / classify_many 批次）
+  - GET /api/analysis            完整端點，N 位使用者同時請求
+
+用法：
+  python benchmark.py                          # 預設 1k,10k,50k 與 4 位並發使用者
+  python benchmark.py --sizes 1000 --users 8 --latency 0.05 --rate-429 0.01
+  python benchmark.py --output bench.json      # 保存結果
+  python benchmark.py --baseline bench.json    # 與先前結果比較，退步超過門檻時 exit 1
+  python benchmark.py --unthrottled            # 拿掉上游節流，只量測程式本身
+
+上游節流預設沿用 main.py 的正式設定（SPOTIFY_RATE_LIMIT / SPOTIFY_RATE_BURST，
+可用環境變數覆寫），量到的是實際部署時的分析時間；--unthrottled 則把兩者調到
+100000。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import zlib
+from typing import Dict, List, Optional
+
+# 匯入 main 之前先給定基準測試用的設定（已設定的環境變數優先）
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("SESSION_STORE", "memory")
+# 保留並行上限但不拒絕請求，量測的是排隊後的吞吐量
+os.environ.setdefault("ANALYSIS_QUEUE_SIZE", "100000")
+os.environ.setdefault("ANALYSIS_QUEUE_TIMEOUT", "3600")
+# 正式節流下大型收藏庫加上多位使用者會超過 ANALYSIS_DEADLINE，基準測試量的是完成所需時間
+os.environ.setdefault("ANALYSIS_DEADLINE", "0")
+os.environ.pop("ARTIST_CACHE_DB", None)
+os.environ.pop("AUDIO_FEATURE_CACHE_DB", None)
+
+import httpx
+
+DEFAULT_SIZES = [1000, 10000, 50000]
+
+# 合成 genre：精確命中、子字串命中與未知 genre 混合，接近真實分布
+SYNTHETIC_GENRES = [
+    "pop", "k-pop", "mandopop", "indie pop", "dance pop", "rock", "indie rock",
+    "alternative rock", "hip hop", "rap", "trap", "r&b", "neo soul", "edm",
+    "deep house", "techno", "jazz", "jazz fusion", "folk", "indie folk",
+    "classical", "lo-fi beats", "ambient", "metal", "punk", "reggaeton",
+    "taiwan indie", "japanese city pop", "korean r&b", "modern blues rock",
+    "chill lounge", "latin pop", "country rock", "bedroom pop", "shoegaze",
+]
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def peak_rss_mb() -> float:
+    # Linux 的 ru_maxrss 單位為 KB，macOS 為 bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+class FakeSpotify:
+    """合成收藏庫的假 Spotify API（MockTransport handler）
+
+    artist_ratio 為不重複藝人數 / 歌曲數，越小代表藝人重疊越多；
+    rate_429 為每個請求回 429（附 Retry-After）的機率。
+    """
+
+    def __init__(
+        self,
+        tracks: int,
+        artist_ratio: float = 0.3,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_429: float = 0.0,
+        retry_after: int = 1,
+        unknown_genres: int = 2000,
+        seed: int = 42,
+    ):
+        rng = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self._rng = random.Random(seed + 1)
+        self.calls: Dict[str, int] = {}
+        self.throttled = 0
+
+        genre_pool = SYNTHETIC_GENRES + [f"scene {i} wave" for i in range(unknown_genres)]
+        artist_count = max(1, int(tracks * artist_ratio))
+        self.artists = {
+            f"artist{i:07d}": rng.sample(genre_pool, rng.randint(0, 4))
+            for i in range(artist_count)
+        }
+        artist_ids = list(self.artists)
+        self.tracks = []
+        for i in range(tracks):
+            track_artists = [rng.choice(artist_ids) for _ in range(rng.choice((1, 1, 1, 2, 3)))]
+            self.tracks.append({
+                "added_at": f"20{10 + i % 15:02d}-{1 + i % 12:02d}-{1 + i % 28:02d}T00:00:00Z",
+                "track": {
+                    "id": f"track{i:07d}",
+                    "name": f"Track {i}",
+                    "album": {"name": f"Album {i // 10}", "images": [{"url": "https://i.scdn.co/image/x"}]},
+                    "artists": [{"id": aid, "name": aid} for aid in track_artists],
+                },
+            })
+
+    @staticmethod
+    def audio_features(track_id: str) -> Dict:
+        # 由 ID 決定的假特徵，重複執行時結果一致
+        seed = zlib.crc32(track_id.encode())
+        return {
+            "id": track_id,
+            "energy": (seed % 1000) / 1000,
+            "valence": (seed // 1000 % 1000) / 1000,
+            "danceability": (seed // 1000000 % 1000) / 1000,
+            "tempo": 60 + seed % 140,
+        }
+
+    def reset_counters(self):
+        self.calls = {}
+        self.throttled = 0
+
+    @property
+    def upstream_requests(self) -> int:
+        return sum(self.calls.values())
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        self.calls[path] = self.calls.get(path, 0) + 1
+        delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.rate_429 and self._rng.random() < self.rate_429:
+            self.throttled += 1
+            return httpx.Response(429, headers={"Retry-After": str(self.retry_after)})
+
+        params = request.url.params
+        if path == "/v1/me/tracks":
+            offset = int(params.get("offset", 0))
+            limit = int(params.get("limit", 20))
+            items = self.tracks[offset:offset + limit]
+            has_next = offset + limit < len(self.tracks)
+            return httpx.Response(200, json={
+                "items": items,
+                "total": len(self.tracks),
+                "offset": offset,
+                "limit": limit,
+                "next": f"{request.url}&page=next" if has_next else None,
+            })
+        if path == "/v1/artists":
+            ids = params.get("ids", "").split(",")
+            return httpx.Response(200, json={
+                "artists": [{"id": aid, "genres": self.artists.get(aid, [])} for aid in ids],
+            })
+        if path == "/v1/audio-features":
+            ids = params.get("ids", "").split(",")
+            return httpx.Response(200, json={
+                "audio_features": [self.audio_features(track_id) for track_id in ids],
+            })
+        if path == "/v1/me":
+            # 以 token 區分使用者，讓每位並發使用者各自有快照
+            token = request.headers.get("Authorization", "").replace("Bearer ", "")
+            return httpx.Response(200, json={"id": f"user-{token}", "display_name": token})
+        return httpx.Response(404, json={"error": {"status": 404, "message": "not found"}})
+
+def reset_state(main):
+    """清空各層快取，讓每個情境都從冷狀態開始"""
+    main.ARTIST_GENRE_CACHE = main.TTLCache("artist_genres", main.ARTIST_GENRE_CACHE.maxsize, main.ARTIST_GENRE_CACHE.ttl)
+    main.AUDIO_FEATURE_CACHE = main.TTLCache("audio_features", main.AUDIO_FEATURE_CACHE.maxsize, main.AUDIO_FEATURE_CACHE.ttl)
+    main.LIBRARY_SNAPSHOTS.clear()
+    main.ANALYSIS_FLIGHTS = main.SingleFlight(ttl=main.ANALYSIS_RESULT_TTL)
+    main.SCHEDULERS.clear()
+
+async def timed(coro) -> tuple:
+    start = time.perf_counter()
+    result = await coro
+    return time.perf_counter() - start, result
+
+async def bench_saved_tracks(main, fake: FakeSpotify) -> Dict:
+    reset_state(main)
+    fake.reset_counters()
+    elapsed, tracks = await timed(main.fetch_user_saved_tracks("bench", compact=True))
+    assert len(tracks) == len(fake.tracks), "saved tracks mismatch"
+    return {
+        "seconds": round(elapsed, 4),
+        "upstream_requests": fake.upstream_requests,
+        "throttled": fake.throttled,
+        "tracks_per_second": round(len(tracks) / elapsed, 1),
+    }
+
+async def bench_artists(main, fake: FakeSpotify) -> Dict:
+    reset_state(main)
+    artist_ids = main.collect_artist_ids(main.project_saved_tracks(fake.tracks))
+    fake.reset_counters()
+    cold, genres = await timed(main.fetch_artists_genres("bench", artist_ids))
+    cold_requests = fake.upstream_requests
+    fake.reset_counters()
+    warm, _ = await timed(main.fetch_artists_genres("bench", artist_ids))
+    assert len(genres) == len(artist_ids), "artist genres mismatch"
+    return {
+        "artists": len(artist_ids),
+        "cold_seconds": round(cold, 4),
+        "cold_upstream_requests": cold_requests,
+        "warm_seconds": round(warm, 4),
+        "warm_upstream_requests": fake.upstream_requests,
+    }
+
+def bench_genre_mapping(main, fake: FakeSpotify, repeat: int = 3) -> Dict:
+    # 依歌曲展開 genre（重複出現的 genre 也計入），與實際分析時的呼叫量相當
+    genres = [
+        genre
+        for item in fake.tracks
+        for artist in item["track"]["artists"]
+        for genre in fake.artists[artist["id"]]
+    ]
+    def new_classifier():
+        return main.GenreClassifier(
+            main.GENRE_BUCKET_MAP,
+            main.GENRE_PRIORITY_KEYWORDS,
+            memo_size=main.GENRE_CLASSIFIER.memo_size,
+        )
+
+    start = time.perf_counter()
+    new_classifier().classify_many(genres)
+    batch = time.perf_counter() - start
+    classifier = new_classifier()
+    original = main.GENRE_CLASSIFIER
+    main.GENRE_CLASSIFIER = classifier
+    try:
+        start = time.perf_counter()
+        for genre in genres:
+            main.map_genre_to_bucket(genre)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for genre in genres:
+                main.map_genre_to_bucket(genre)
+        warm = (time.perf_counter() - start) / repeat
+    finally:
+        main.GENRE_CLASSIFIER = original
+    return {
+        "calls": len(genres),
+        "distinct": len(set(genres)),
+        "cold_seconds": round(cold, 4),
+        "warm_seconds": round(warm, 4),
+        "batch_seconds": round(batch, 4),
+        "calls_per_second": round(len(genres) / warm, 1) if warm else None,
+    }
+
+async def bench_endpoint(main, fake: FakeSpotify, users: int) -> Dict:
+    reset_state(main)
+    fake.reset_counters()
+    expires_at = time.time() + 3600
+    for i in range(users):
+        main.SESSION_STORE.save(f"bench-{i}", {
+            "id": f"bench-{i}",
+            "access_token": f"token{i}",
+            "refresh_token": "refresh",
+            "expires_at": expires_at,
+        })
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        async def one_user(i: int) -> float:
+            start = time.perf_counter()
+            response = await client.get("/api/analysis", headers={"X-Session-ID": f"bench-{i}"})
+            response.raise_for_status()
+            assert response.json()["total_tracks"] == len(fake.tracks), "analysis mismatch"
+            return time.perf_counter() - start
+
+        wall_start = time.perf_counter()
+        latencies = await asyncio.gather(*(one_user(i) for i in range(users)))
+        wall = time.perf_counter() - wall_start
+
+    for i in range(users):
+        main.SESSION_STORE.delete(f"bench-{i}")
+    return {
+        "users": users,
+        "p50_seconds": round(percentile(latencies, 50), 4),
+        "p95_seconds": round(percentile(latencies, 95), 4),
+        "max_seconds": round(max(latencies), 4),
+        "wall_seconds": round(wall, 4),
+        "requests_per_second": round(users / wall, 2),
+        "tracks_per_second": round(users * len(fake.tracks) / wall, 1),
+        "upstream_requests": fake.upstream_requests,
+        "upstream_by_path": dict(sorted(fake.calls.items())),
+        "throttled": fake.throttled,
+    }
+
+async def run_size(args, size: int) -> Dict:
+    if args.unthrottled:
+        os.environ["SPOTIFY_RATE_LIMIT"] = os.environ["SPOTIFY_RATE_BURST"] = "100000"
+    import main
+
+    fake = FakeSpotify(
+        size,
+        artist_ratio=args.artist_ratio,
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_429=args.rate_429,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    main.HTTP_CLIENT = httpx.AsyncClient(transport=httpx.MockTransport(fake.handler))
+    try:
+        results = {"tracks": size, "rate_limit": main.SPOTIFY_RATE_LIMIT, "rate_burst": main.SPOTIFY_RATE_BURST}
+        results["fetch_user_saved_tracks"] = await bench_saved_tracks(main, fake)
+        results["fetch_artists_genres"] = await bench_artists(main, fake)
+        results["map_genre_to_bucket"] = bench_genre_mapping(main, fake)
+        results["api_analysis"] = await bench_endpoint(main, fake, args.users)
+        results["peak_rss_mb"] = peak_rss_mb()
+        return results
+    finally:
+        await main.HTTP_CLIENT.aclose()
+        main.HTTP_CLIENT = None
+
+def run_isolated(args, size: int) -> Dict:
+    """在子程序中跑單一收藏庫大小，peak RSS 才不會被前一個大小污染"""
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--sizes", str(size)]
+    for flag in ("users", "artist_ratio", "latency", "jitter", "rate_429", "retry_after", "seed"):
+        command += [f"--{flag.replace('_', '-')}", str(getattr(args, flag))]
+    if args.unthrottled:
+        command.append("--unthrottled")
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        sys.stderr.write(completed.stderr)
+        raise SystemExit(f"benchmark for {size} tracks failed")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+# (指標路徑, 說明)；數值越大代表越差
+REGRESSION_METRICS = [
+    (("fetch_user_saved_tracks", "seconds"), "saved tracks seconds"),
+    (("fetch_user_saved_tracks", "upstream_requests"), "saved tracks requests"),
+    (("fetch_artists_genres", "cold_seconds"), "artists cold seconds"),
+    (("fetch_artists_genres", "cold_upstream_requests"), "artists requests"),
+    (("map_genre_to_bucket", "cold_seconds"), "genre mapping cold seconds"),
+    (("map_genre_to_bucket", "warm_seconds"), "genre mapping warm seconds"),
+    (("map_genre_to_bucket", "batch_seconds"), "genre mapping batch seconds"),
+    (("api_analysis", "p95_seconds"), "analysis p95 seconds"),
+    (("api_analysis", "upstream_requests"), "analysis requests"),
+    (("peak_rss_mb",), "peak RSS MB"),
+]
+
+def find_regressions(current: List[Dict], baseline: List[Dict], tolerance: float, min_seconds: float = 0.01) -> List[str]:
+    """比較同樣大小的結果，回傳超過容許比例的退步項目"""
+    baseline_by_size = {entry["tracks"]: entry for entry in baseline}
+    regressions = []
+    for entry in current:
+        previous = baseline_by_size.get(entry["tracks"])
+        if previous is None:
+            continue
+        for path, label in REGRESSION_METRICS:
+            now, before = entry, previous
+            for key in path:
+                now, before = now.get(key), before.get(key) if before else None
+            if now is None or before is None:
+                continue
+            # 極短的時間量測雜訊太大，低於 min_seconds 不判定
+            if path[-1].endswith("seconds") and max(now, before) < min_seconds:
+                continue
+            if now > before * (1 + tolerance):
+                change = (now / before - 1) * 100 if before else float("inf")
+                regressions.append(f"{entry['tracks']} tracks: {label} {before} -> {now} (+{change:.0f}%)")
+    return regressions
+
+def print_report(results: List[Dict]):
+    if results:
+        print(f"upstream rate limit: {results[0]['rate_limit']:g}/s, burst {results[0]['rate_burst']:g}")
+    header = f"{'tracks':>7} {'saved s':>8} {'reqs':>5} {'artists s':>9} {'reqs':>5} {'genre ms':>9} {'p50 s':>7} {'p95 s':>7} {'req/s':>7} {'upstream':>8} {'429':>4} {'RSS MB':>7}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        saved, artists = r["fetch_user_saved_tracks"], r["fetch_artists_genres"]
+        genres, endpoint = r["map_genre_to_bucket"], r["api_analysis"]
+        print(
+            f"{r['tracks']:>7} {saved['seconds']:>8.3f} {saved['upstream_requests']:>5} "
+            f"{artists['cold_seconds']:>9.3f} {artists['cold_upstream_requests']:>5} "
+            f"{genres['warm_seconds'] * 1000:>9.2f} {endpoint['p50_seconds']:>7.3f} {endpoint['p95_seconds']:>7.3f} "
+            f"{endpoint['requests_per_second']:>7.2f} {endpoint['upstream_requests']:>8} {endpoint['throttled']:>4} "
+            f"{r['peak_rss_mb']:>7.1f}"
+        )
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Spotify 音樂分析器離線效能基準測試")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="收藏庫歌曲數，以逗號分隔")
+    parser.add_argument("--users", type=int, default=4, help="同時請求 /api/analysis 的使用者數")
+    parser.add_argument("--artist-ratio", type=float, default=0.3, help="不重複藝人數 / 歌曲數（越小重疊越多）")
+    parser.add_argument("--latency", type=float, default=0.0, help="每個上游請求的基本延遲秒數")
+    parser.add_argument("--jitter", type=float, default=0.0, help="額外隨機延遲的上限秒數")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="上游回 429 的機率")
+    parser.add_argument("--retry-after", type=int, default=1, help="429 回應的 Retry-After 秒數")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="將結果寫入 JSON 檔")
+    parser.add_argument("--baseline", help="與先前輸出的 JSON 比較")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許的退步比例（預設 20%%）")
+    parser.add_argument("--unthrottled", action="store_true", help="拿掉上游節流（SPOTIFY_RATE_LIMIT / BURST = 100000）")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    if args.worker:
+        print(json.dumps(asyncio.run(run_size(args, sizes[0]))))
+        return 0
+
+    results = [run_isolated(args, size) for size in sizes]
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            print("\n效能退步：")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\n與 baseline 相比沒有超過門檻的退步")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,21 +1,66 @@
 # main.py
+import asyncio
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
 import os
+import random
+import re
+import sqlite3
+import sys
+import threading
 import time
 import uuid
-from typing import Dict, List
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from email.utils import formatdate
+from mimetypes import guess_type
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 from urllib.parse import urlencode
 
 from fastapi import FastAPI, Request, Response, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-from fastapi.responses import FileResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, ORJSONResponse
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 from dotenv import load_dotenv
 from fastapi import Query
 import httpx
+import numpy as np
 
+# prometheus_client 在匯入時就依 PROMETHEUS_MULTIPROC_DIR 決定是否寫入多程序指標檔，
+# 必須先載入 .env，只寫在 .env 裡的設定才會生效
 load_dotenv()
 
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+try:
+    import orjson
+except ImportError:  # 沒安裝 orjson 時退回標準庫 json
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # 沒有 brotli 時靜態檔案與動態回應都只提供 gzip
+    brotli = None
+
+try:
+    from scipy import sparse
+    from scipy.cluster.hierarchy import fcluster, linkage
+    from scipy.spatial.distance import squareform
+except ImportError:  # 沒安裝 scipy 時分析結果不含 genre_graph
+    sparse = None
+
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("REDIRECT_URI", "http://localhost:8000/callback")
@@ -24,7 +69,568 @@ SCOPE = "user-library-read user-top-read"
 if not (SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET):
     raise RuntimeError("請在 .env 裡設定 SPOTIFY_CLIENT_ID / SPOTIFY_CLIENT_SECRET")
 
-app = FastAPI()
+# 結構化日誌：LOG_LEVEL 控制輸出等級，LOG_FORMAT=json 時每行一個 JSON 物件
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+
+# 目前請求的 request ID（由 RequestContextMiddleware 設定，背景 task 會繼承）
+REQUEST_ID: ContextVar[str] = ContextVar("request_id", default="-")
+
+_STANDARD_LOG_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+class StructuredFormatter(logging.Formatter):
+    """把 logger 的 extra 欄位與 request ID 一起輸出成 JSON 或 key=value"""
+    
+    def __init__(self, as_json: bool = True):
+        super().__init__()
+        self.as_json = as_json
+    
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {key: value for key, value in record.__dict__.items() if key not in _STANDARD_LOG_FIELDS}
+        if self.as_json:
+            entry = {
+                "ts": round(record.created, 3),
+                "level": record.levelname,
+                "request_id": getattr(record, "request_id", "-"),
+                "msg": record.getMessage(),
+                **fields,
+            }
+            if record.exc_info:
+                entry["exc"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = f"{self.formatTime(record)} {record.levelname} [{getattr(record, 'request_id', '-')}] {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = REQUEST_ID.get()
+        return True
+
+logger = logging.getLogger("spotify_analyzer")
+
+def setup_logging():
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestIdFilter())
+    handler.setFormatter(StructuredFormatter(as_json=LOG_FORMAT == "json"))
+    logger.handlers = [handler]
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+setup_logging()
+
+# Prometheus 指標（多 worker 時設定 PROMETHEUS_MULTIPROC_DIR 以彙整各程序的數據）
+UPSTREAM_LATENCY = Histogram(
+    "spotify_upstream_request_duration_seconds",
+    "Latency of individual Spotify API requests",
+    ["endpoint", "status"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0),
+)
+UPSTREAM_RETRIES = Counter(
+    "spotify_upstream_retries_total", "Spotify requests retried by the scheduler", ["endpoint", "reason"]
+)
+HEDGED_REQUESTS = Counter(
+    "spotify_hedged_requests_total", "Hedged GET requests sent to Spotify, and how many finished first", ["endpoint", "outcome"]
+)
+CIRCUIT_STATE = Gauge(
+    "spotify_circuit_state", "Circuit breaker state per upstream host (0 closed, 1 half-open, 2 open)", ["host"], multiprocess_mode="max"
+)
+CIRCUIT_TRANSITIONS = Counter("spotify_circuit_transitions_total", "Circuit breaker state changes", ["host", "state"])
+TOKEN_REFRESHES = Counter(
+    "token_refreshes_total", "Access token refreshes by outcome (joined = waited on an in-flight refresh, reused = another worker already refreshed)", ["outcome"]
+)
+TRACK_PAGES_FETCHED = Counter("analysis_track_pages_total", "Saved-track pages fetched from Spotify")
+ARTIST_BATCHES_FETCHED = Counter("analysis_artist_batches_total", "Artist batches fetched from /v1/artists")
+AUDIO_FEATURE_BATCHES_FETCHED = Counter("analysis_audio_feature_batches_total", "Audio feature batches fetched from /v1/audio-features")
+ACTIVE_SESSIONS = Gauge("active_sessions", "Unexpired sessions in the session store", multiprocess_mode="max")
+ANALYSES_IN_FLIGHT = Gauge("analyses_in_flight", "Library analyses currently being computed", multiprocess_mode="livesum")
+ANALYSIS_QUEUE_DEPTH = Gauge("analysis_queue_depth", "Analyses waiting for an admission slot", multiprocess_mode="livesum")
+ANALYSIS_REJECTED = Counter("analysis_rejected_total", "Analyses shed by admission control", ["reason"])
+ANALYSIS_PHASE_LATENCY = Histogram(
+    "analysis_phase_duration_seconds",
+    "Time spent per /api/analysis phase; artist_fetch only counts waiting that is not overlapped with track paging",
+    ["phase", "mode"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Latency of requests served by this app",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+# 目前工作的上游截止時間（time.monotonic()），由 deadline() 設定，其中的 Spotify 呼叫都會遵守
+REQUEST_DEADLINE: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+@contextmanager
+def deadline(seconds: float):
+    """在 seconds 秒內必須完成的區段；巢狀時取較早的截止時間，seconds <= 0 代表不另設限制"""
+    current = REQUEST_DEADLINE.get()
+    if seconds <= 0:
+        yield
+        return
+    new = time.monotonic() + seconds
+    token = REQUEST_DEADLINE.set(min(current, new) if current is not None else new)
+    try:
+        yield
+    finally:
+        REQUEST_DEADLINE.reset(token)
+
+def deadline_remaining() -> Optional[float]:
+    current = REQUEST_DEADLINE.get()
+    return None if current is None else current - time.monotonic()
+
+class DeadlineExceeded(HTTPException):
+    """目前工作的截止時間已到，不再送出或等待上游請求"""
+
+def deadline_exceeded() -> DeadlineExceeded:
+    return DeadlineExceeded(status_code=504, detail="Spotify did not respond within the request deadline")
+
+# 每次分析各階段的累計耗時（compute_analysis 設定，phase_timer 累加）
+_PHASE_TIMINGS: ContextVar[Optional[Dict[str, float]]] = ContextVar("phase_timings", default=None)
+
+@contextmanager
+def phase_timer(phase: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _PHASE_TIMINGS.get()
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - started
+
+def env_flag(name: str, default: bool = False) -> bool:
+    """讀取布林型態的環境變數（1/true/yes/on 視為開啟）"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# 上游 HTTP 連線池設定 - 所有 Spotify 呼叫共用同一個 client，避免每個請求都重新做 TCP+TLS 握手
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+# 每個上游 host 的連線上限（api.spotify.com / accounts.spotify.com 各自獨立計算）
+HTTP_PER_HOST_MAX_CONNECTIONS = int(os.getenv("HTTP_PER_HOST_MAX_CONNECTIONS", "20"))
+# HTTP/2 多工（需要安裝 h2，即 httpx[http2]）
+HTTP2_ENABLED = env_flag("HTTP2_ENABLED")
+
+SPOTIFY_HOSTS = ("api.spotify.com", "accounts.spotify.com")
+
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+def create_http_client() -> httpx.AsyncClient:
+    """建立共用的 AsyncClient，Spotify 各 host 使用獨立的連線池與上限"""
+    per_host_limits = httpx.Limits(
+        max_connections=HTTP_PER_HOST_MAX_CONNECTIONS,
+        max_keepalive_connections=min(HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_PER_HOST_MAX_CONNECTIONS),
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    mounts = {
+        f"https://{host}": httpx.AsyncHTTPTransport(limits=per_host_limits, http2=HTTP2_ENABLED)
+        for host in SPOTIFY_HOSTS
+    }
+    return httpx.AsyncClient(
+        timeout=20.0,
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        mounts=mounts,
+    )
+
+def get_http_client() -> httpx.AsyncClient:
+    """取得共用 client；若未經 lifespan 啟動（例如直接呼叫函數）則延遲建立"""
+    global HTTP_CLIENT
+    if HTTP_CLIENT is None or HTTP_CLIENT.is_closed:
+        HTTP_CLIENT = create_http_client()
+    return HTTP_CLIENT
+
+# Spotify 請求排程：每個 client ID 共用一個 token bucket，互動式請求優先於批量分頁
+# Spotify 以 30 秒滾動視窗計算每個 app 的請求數，額度未公開（development mode 較低）。
+# 持續速率 10/s（每個視窗約 300 個）是保守值；視窗內只看總數，所以 burst 給到 100，
+# 讓一般大小的收藏庫冷啟動分析不必被逐一節流。任何 30 秒內最多 burst + 30 × rate 個
+# 請求；超過額度時 429 的 Retry-After 會暫停整個 bucket。取得 extended quota 後可調高。
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "10"))  # 每秒補充的請求數
+SPOTIFY_RATE_BURST = float(os.getenv("SPOTIFY_RATE_BURST", "100"))
+# uvicorn worker 數（Procfile 的 --workers）。bucket 在每個 worker 各有一份，
+# 依 worker 數平分，上面兩個值才會是整個 app 的總量
+WEB_WORKERS = max(1, int(os.getenv("WEB_WORKERS", "1")))
+SPOTIFY_MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", "3"))
+SPOTIFY_BACKOFF_BASE = float(os.getenv("SPOTIFY_BACKOFF_BASE", "0.5"))
+SPOTIFY_BACKOFF_MAX = float(os.getenv("SPOTIFY_BACKOFF_MAX", "8"))
+
+PRIORITY_INTERACTIVE = 0  # /api/status、/api/top-* 等使用者正在等待的請求
+PRIORITY_BULK = 1  # 分析時的大量分頁 / 批次請求
+
+class RateLimitScheduler:
+    """有優先序的 token bucket
+    
+    token 足夠且沒有人排隊時直接放行；否則依 (priority, 先來後到) 排隊，
+    由單一計時器在 token 補充後依序喚醒。pause() 用於遵守 429 的 Retry-After，
+    暫停期間所有請求（不分優先序）都會等待。
+    """
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def _try_take(self, now: float) -> bool:
+        if now < self.paused_until:
+            return False
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 事件迴圈更換（例如測試中重新 asyncio.run）時丟棄舊的等待者
+            self._loop = loop
+            self._waiters = []
+            self._wakeup = None
+        return loop
+    
+    async def acquire(self, priority: int = PRIORITY_BULK):
+        loop = self._bind_loop()
+        if not self._waiters and self._try_take(time.monotonic()):
+            return
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配到 token 但呼叫端被取消，歸還 token
+                self.tokens = min(self.capacity, self.tokens + 1)
+                self._dispatch()
+            raise
+    
+    def try_acquire(self) -> bool:
+        """不等待地取得 token（沒有人排隊且 token 足夠時才成功）"""
+        self._bind_loop()
+        return not self._waiters and self._try_take(time.monotonic())
+    
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    def _dispatch(self):
+        now = time.monotonic()
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._try_take(now):
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+        if self._waiters and self._wakeup is None:
+            delay = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.001)
+            self._wakeup = self._loop.call_later(delay, self._on_wakeup)
+    
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+    
+    def stats(self) -> Dict:
+        return {
+            "tokens": round(self.tokens, 2),
+            "waiting": sum(1 for _, _, f in self._waiters if not f.done()),
+            "paused_for": max(0.0, round(self.paused_until - time.monotonic(), 2)),
+        }
+
+SCHEDULERS: Dict[str, RateLimitScheduler] = {}
+
+def get_scheduler(client_id: Optional[str] = None) -> RateLimitScheduler:
+    client_id = client_id or SPOTIFY_CLIENT_ID
+    if client_id not in SCHEDULERS:
+        SCHEDULERS[client_id] = RateLimitScheduler(SPOTIFY_RATE_LIMIT / WEB_WORKERS, SPOTIFY_RATE_BURST / WEB_WORKERS)
+    return SCHEDULERS[client_id]
+
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+def backoff_delay(attempt: int) -> float:
+    """指數退避加上 full jitter"""
+    return random.uniform(0, min(SPOTIFY_BACKOFF_MAX, SPOTIFY_BACKOFF_BASE * (2 ** attempt)))
+
+# 熔斷器：同一個 host 連續失敗（5xx / 連線錯誤 / 逾時）達門檻後開啟，期間請求立即失敗
+CIRCUIT_BREAKER_ENABLED = env_flag("CIRCUIT_BREAKER", True)
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+class UpstreamUnavailable(HTTPException):
+    """熔斷器開啟中，沒有實際送出請求就失敗"""
+
+class CircuitBreaker:
+    """單一上游 host 的熔斷器
+    
+    closed 時正常放行並累計連續失敗；達門檻轉為 open，reset_timeout 秒內的請求直接
+    拋出 UpstreamUnavailable（503 + Retry-After）。之後轉為 half_open，只放行一個探測
+    請求：成功則回到 closed，失敗則再次 open。狀態變化會記錄日誌與指標。
+    """
+    
+    def __init__(self, host: str, failure_threshold: int, reset_timeout: float):
+        self.host = host
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        CIRCUIT_STATE.labels(host).set(CIRCUIT_STATES["closed"])
+    
+    def _transition(self, state: str):
+        log = logger.warning if state == "open" else logger.info
+        log("circuit breaker state changed", extra={"upstream": self.host, "from": self.state, "to": state, "failures": self.failures})
+        self.state = state
+        CIRCUIT_STATE.labels(self.host).set(CIRCUIT_STATES[state])
+        CIRCUIT_TRANSITIONS.labels(self.host, state).inc()
+    
+    def _unavailable(self, retry_after: float) -> UpstreamUnavailable:
+        return UpstreamUnavailable(
+            status_code=503,
+            detail="Spotify is currently unavailable, please retry later",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+        )
+    
+    def before_request(self):
+        """請求送出前呼叫；熔斷中（或 half-open 已有探測請求）時拋出 UpstreamUnavailable"""
+        if self.state == "closed":
+            return
+        if self.state == "open":
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                raise self._unavailable(remaining)
+            self._transition("half_open")
+        if self._probing:
+            raise self._unavailable(1)
+        self._probing = True
+    
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != "closed":
+            self._transition("closed")
+    
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self._transition("open")
+    
+    def abandon(self):
+        """請求沒有結果就結束（例如被取消），讓下一個請求可以擔任探測"""
+        self._probing = False
+
+CIRCUIT_BREAKERS: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(host: str) -> Optional[CircuitBreaker]:
+    if not CIRCUIT_BREAKER_ENABLED:
+        return None
+    if host not in CIRCUIT_BREAKERS:
+        CIRCUIT_BREAKERS[host] = CircuitBreaker(host, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+    return CIRCUIT_BREAKERS[host]
+
+# Hedged request：GET 分頁超過該端點近期 p95 延遲仍未回應時，再送出一個相同請求，取先完成者
+SPOTIFY_HEDGING = env_flag("SPOTIFY_HEDGING", False)
+SPOTIFY_HEDGE_MIN_DELAY = float(os.getenv("SPOTIFY_HEDGE_MIN_DELAY", "0.05"))
+
+class LatencyTracker:
+    """各上游端點最近成功請求的延遲，用來估計 p95；樣本不足時不提供估計"""
+    
+    def __init__(self, window: int = 200, min_samples: int = 20, recompute_every: int = 10):
+        self.window = window
+        self.min_samples = min_samples
+        self.recompute_every = recompute_every
+        self._samples: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+        self._p95: Dict[str, float] = {}
+    
+    def record(self, endpoint: str, seconds: float):
+        samples = self._samples.get(endpoint)
+        if samples is None:
+            samples = self._samples[endpoint] = deque(maxlen=self.window)
+        samples.append(seconds)
+        count = self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+        if len(samples) >= self.min_samples and count % self.recompute_every == 0:
+            self._p95[endpoint] = float(np.percentile(samples, 95))
+    
+    def p95(self, endpoint: str) -> Optional[float]:
+        return self._p95.get(endpoint)
+
+UPSTREAM_LATENCY_TRACKER = LatencyTracker()
+
+async def hedged_request(scheduler: RateLimitScheduler, endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+    """送出請求；超過 p95 仍未完成且 rate limit 有餘裕時再送一個備援請求，回傳先成功的結果"""
+    client = get_http_client()
+    primary = asyncio.create_task(client.request(method, url, **kwargs))
+    tasks = {primary}
+    try:
+        p95 = UPSTREAM_LATENCY_TRACKER.p95(endpoint)
+        if p95 is not None:
+            done, _ = await asyncio.wait(tasks, timeout=max(SPOTIFY_HEDGE_MIN_DELAY, p95))
+            # 備援請求也要消耗 rate limit，只在不需要排隊時才送出
+            if not done and scheduler.try_acquire():
+                HEDGED_REQUESTS.labels(endpoint, "sent").inc()
+                tasks.add(asyncio.create_task(client.request(method, url, **kwargs)))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        HEDGED_REQUESTS.labels(endpoint, "won").inc()
+                    return task.result()
+        # 全部失敗時拋出主要請求的錯誤
+        return primary.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+async def spotify_request(
+    method: str,
+    url: str,
+    *,
+    priority: int = PRIORITY_BULK,
+    hedge: bool = False,
+    circuit_breaker: bool = True,
+    timeout: float = 20.0,
+    **kwargs,
+) -> httpx.Response:
+    """所有 Spotify 呼叫的統一入口：經過 rate limit 排程，429 依 Retry-After 重試
+    
+    GET 請求遇到 5xx 或連線錯誤時以 jittered backoff 重試；POST（token 交換）
+    只在 429 時重試，避免重複送出已被處理的授權碼。
+    
+    排隊、請求逾時與重試等待都受 deadline() 設定的截止時間限制，時間用完拋出 504；
+    host 的熔斷器開啟時直接拋出 UpstreamUnavailable。hedge=True 的 GET 在啟用
+    SPOTIFY_HEDGING 時會以 hedged request 送出。circuit_breaker=False 的請求不受熔斷器
+    限制也不計入它的狀態（給失敗不代表整個上游故障的選用端點）。
+    """
+    scheduler = get_scheduler()
+    idempotent = method.upper() == "GET"
+    parsed_url = httpx.URL(url)
+    endpoint = parsed_url.path
+    breaker = get_circuit_breaker(parsed_url.host) if circuit_breaker else None
+    hedge = hedge and idempotent and SPOTIFY_HEDGING
+    attempt = 0
+    while True:
+        remaining = deadline_remaining()
+        if remaining is not None and remaining <= 0:
+            raise deadline_exceeded()
+        try:
+            await asyncio.wait_for(scheduler.acquire(priority), remaining)
+        except asyncio.TimeoutError:
+            raise deadline_exceeded() from None
+        if breaker is not None:
+            breaker.before_request()
+        remaining = deadline_remaining()
+        request_timeout = timeout if remaining is None else max(0.001, min(timeout, remaining))
+        started = time.perf_counter()
+        recorded = False
+        try:
+            if hedge:
+                r = await hedged_request(scheduler, endpoint, method, url, timeout=request_timeout, **kwargs)
+            else:
+                r = await get_http_client().request(method, url, timeout=request_timeout, **kwargs)
+        except httpx.TransportError as e:
+            if breaker is not None:
+                breaker.record_failure()
+            recorded = True
+            UPSTREAM_LATENCY.labels(endpoint, "error").observe(time.perf_counter() - started)
+            if isinstance(e, httpx.TimeoutException) and remaining is not None and deadline_remaining() <= 0:
+                raise deadline_exceeded() from e
+            if not idempotent or attempt >= SPOTIFY_MAX_RETRIES:
+                raise
+            logger.warning("spotify transport error, retrying", extra={"endpoint": endpoint, "error": str(e), "attempt": attempt})
+            UPSTREAM_RETRIES.labels(endpoint, "transport").inc()
+            delay = backoff_delay(attempt)
+        else:
+            elapsed = time.perf_counter() - started
+            if breaker is not None:
+                if r.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            recorded = True
+            UPSTREAM_LATENCY.labels(endpoint, str(r.status_code)).observe(elapsed)
+            if r.status_code < 400:
+                UPSTREAM_LATENCY_TRACKER.record(endpoint, elapsed)
+            if r.status_code == 429 and attempt < SPOTIFY_MAX_RETRIES:
+                retry_after = parse_retry_after(r)
+                if retry_after is None:
+                    retry_after = backoff_delay(attempt)
+                logger.warning("spotify rate limited", extra={"endpoint": endpoint, "retry_after": retry_after, "attempt": attempt})
+                UPSTREAM_RETRIES.labels(endpoint, "429").inc()
+                # 暫停整個 bucket，其他請求也不再送出直到 Retry-After 結束
+                scheduler.pause(retry_after)
+                delay = random.uniform(0, SPOTIFY_BACKOFF_BASE)
+            elif r.status_code >= 500 and idempotent and attempt < SPOTIFY_MAX_RETRIES:
+                logger.warning("spotify server error, retrying", extra={"endpoint": endpoint, "status": r.status_code, "attempt": attempt})
+                UPSTREAM_RETRIES.labels(endpoint, "5xx").inc()
+                delay = backoff_delay(attempt)
+            else:
+                return r
+        finally:
+            if breaker is not None and not recorded:
+                breaker.abandon()
+        attempt += 1
+        remaining = deadline_remaining()
+        if remaining is not None and delay >= remaining:
+            # 剩下的時間不夠再重試一次
+            raise deadline_exceeded()
+        await asyncio.sleep(delay)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global HTTP_CLIENT
+    HTTP_CLIENT = create_http_client()
+    sweeper = asyncio.create_task(sweep_expired_sessions())
+    refresher = asyncio.create_task(refresh_active_analyses()) if ANALYSIS_REFRESH_INTERVAL > 0 else None
+    # 壓縮在背景 thread 進行，完成前靜態檔案照常以未壓縮的方式提供
+    spawn_background(asyncio.to_thread(precompress_static_assets))
+    try:
+        yield
+    finally:
+        sweeper.cancel()
+        if refresher is not None:
+            refresher.cancel()
+        TOKEN_MANAGER.close()
+        for task in list(BACKGROUND_TASKS):
+            task.cancel()
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT = None
+        shutdown_aggregation_pool()
+
+# 有 orjson 時 JSON 回應一律以 orjson 序列化，比 json.dumps 快數倍
+DefaultJSONResponse = ORJSONResponse if orjson is not None else JSONResponse
+
+app = FastAPI(lifespan=lifespan, default_response_class=DefaultJSONResponse)
 
 # 動態 CORS 設定 - 支援開發和生產環境
 ALLOWED_ORIGINS = [
@@ -39,8 +645,123 @@ PRODUCTION_URL = os.getenv("PRODUCTION_URL")
 if PRODUCTION_URL:
     ALLOWED_ORIGINS.append(PRODUCTION_URL)
 
-print(f"DEBUG - CORS ALLOWED_ORIGINS: {ALLOWED_ORIGINS}")
-print(f"DEBUG - REDIRECT_URI: {REDIRECT_URI}")
+logger.info("startup config", extra={"allowed_origins": ALLOWED_ORIGINS, "redirect_uri": REDIRECT_URI})
+
+class RequestContextMiddleware:
+    """為每個請求設定 request ID（沿用 X-Request-ID 或新產生）並記錄延遲"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = ""
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        token = REQUEST_ID.set(request_id)
+        status_code = 500
+        started = time.perf_counter()
+        
+        async def send_with_request_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            # 以路由樣板（或掛載點）作為標籤，避免路徑造成過高的基數
+            route = scope.get("route")
+            route_label = getattr(route, "path", None) or scope.get("root_path") or "unmatched"
+            HTTP_LATENCY.labels(scope["method"], route_label, str(status_code)).observe(time.perf_counter() - started)
+            REQUEST_ID.reset(token)
+
+# 動態回應壓縮：超過門檻的 JSON / 文字回應依 Accept-Encoding 以 brotli 或 gzip 壓縮
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+# 每個請求都要即時壓縮，品質取速度與壓縮率的平衡點
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESSIBLE_CONTENT_TYPES = (
+    "application/json",
+    "application/javascript",
+    "text/html",
+    "text/css",
+    "text/plain",
+    "image/svg+xml",
+)
+
+class CompressionMiddleware:
+    """壓縮一次送出的完整回應；串流回應（NDJSON / SSE、分段的檔案）與已編碼的內容原樣通過
+    
+    串流的事件若經過壓縮器會被緩衝，失去逐步推送的意義，因此只處理單一 body 訊息的回應。
+    原本的 ETag 改為弱 ETag，表示壓縮後的位元組與原始表示不同但語意相同。
+    """
+    
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.available = ("br", "gzip") if brotli is not None else ("gzip",)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = pick_encoding(Headers(scope=scope).get("accept-encoding", ""), self.available)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        start_message = None
+        
+        async def send_compressed(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if start_message is None:
+                await send(message)
+                return
+            start, start_message = start_message, None
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=list(start.get("headers", [])))
+            if message.get("more_body", False) or not self.should_compress(headers, body):
+                await send(start)
+                await send(message)
+                return
+            if encoding == "br":
+                compressed = brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY)
+            else:
+                compressed = gzip.compress(body, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+            if len(compressed) >= len(body):
+                await send(start)
+                await send(message)
+                return
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = "W/" + etag
+            await send({**start, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": compressed})
+        
+        await self.app(scope, receive, send_compressed)
+    
+    def should_compress(self, headers: MutableHeaders, body: bytes) -> bool:
+        if len(body) < self.minimum_size or "content-encoding" in headers:
+            return False
+        content_type = headers.get("content-type", "").partition(";")[0].strip().lower()
+        return content_type in COMPRESSIBLE_CONTENT_TYPES
+
+# 壓縮放在最內層，請求延遲指標也包含壓縮的時間
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(RequestContextMiddleware)
 
 # 添加 CORS 支援
 app.add_middleware(
@@ -51,15 +772,341 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# 靜態檔案：文字類檔案預先壓縮成 gzip / brotli 放在記憶體，依 Accept-Encoding 回傳
+STATIC_DIR = "static"
+STATIC_COMPRESS_MIN_SIZE = int(os.getenv("STATIC_COMPRESS_MIN_SIZE", "1024"))
+STATIC_BROTLI_QUALITY = int(os.getenv("STATIC_BROTLI_QUALITY", "11"))
+COMPRESSIBLE_SUFFIXES = (".js", ".css", ".html", ".svg", ".json", ".map", ".txt")
+# Vite 產生的檔名帶內容雜湊（例如 index-89ZzaUCV.js），內容不會改變，可讓瀏覽器永久快取
+HASHED_ASSET_RE = re.compile(r"-[A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class CompressedAsset:
+    """一個靜態檔案的各種編碼內容（identity 只有 index.html 會保留）"""
+    
+    __slots__ = ("mtime", "size", "etag", "encodings")
+    
+    def __init__(self, mtime: float, size: int, etag: str, encodings: Dict[str, bytes]):
+        self.mtime = mtime
+        self.size = size
+        self.etag = etag
+        self.encodings = encodings
+    
+    def variant_etag(self, encoding: Optional[str]) -> str:
+        # 不同編碼是不同的表示，各自使用不同的 ETag
+        return f'"{self.etag}-{encoding}"' if encoding else f'"{self.etag}"'
+
+COMPRESSED_ASSETS: Dict[str, CompressedAsset] = {}
+
+def load_static_asset(path: str, include_identity: bool = False) -> CompressedAsset:
+    """讀取並壓縮單一檔案；建置時已產生的 .br / .gz 會直接採用"""
+    stat_result = os.stat(path)
+    with open(path, "rb") as f:
+        content = f.read()
+    encodings: Dict[str, bytes] = {}
+    if include_identity:
+        encodings["identity"] = content
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        prebuilt = path + suffix
+        if os.path.exists(prebuilt) and os.stat(prebuilt).st_mtime >= stat_result.st_mtime:
+            with open(prebuilt, "rb") as f:
+                encodings[encoding] = f.read()
+    if "br" not in encodings and brotli is not None:
+        encodings["br"] = brotli.compress(content, quality=STATIC_BROTLI_QUALITY)
+    if "gzip" not in encodings:
+        encodings["gzip"] = gzip.compress(content, compresslevel=9, mtime=0)
+    # 壓縮後沒有變小的編碼就不值得使用
+    for encoding in ("br", "gzip"):
+        if encoding in encodings and len(encodings[encoding]) >= len(content):
+            del encodings[encoding]
+    etag = hashlib.sha1(content).hexdigest()[:20]
+    return CompressedAsset(stat_result.st_mtime, stat_result.st_size, etag, encodings)
+
+def precompress_static_assets(directory: str = STATIC_DIR) -> int:
+    """啟動時把靜態目錄中的文字檔壓縮好；回傳處理的檔案數"""
+    count = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if not name.endswith(COMPRESSIBLE_SUFFIXES) or os.path.getsize(path) < STATIC_COMPRESS_MIN_SIZE:
+                continue
+            try:
+                COMPRESSED_ASSETS[os.path.realpath(path)] = load_static_asset(path)
+                count += 1
+            except OSError:
+                logger.warning("static precompression failed", extra={"path": path}, exc_info=True)
+    logger.info("static assets precompressed", extra={"files": count, "brotli": brotli is not None})
+    return count
+
+def pick_encoding(accept_encoding: str, available) -> Optional[str]:
+    """依 Accept-Encoding 選出可用的編碼，brotli 優先；q=0 代表明確拒絕"""
+    accepted = set()
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        q = params.strip().removeprefix("q=")
+        if params and q.replace(".", "", 1).isdigit() and float(q) == 0:
+            continue
+        accepted.add(token.strip().lower())
+    for encoding in ("br", "gzip"):
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return None
+
+def compressed_asset_response(
+    request_headers: Headers,
+    asset: CompressedAsset,
+    media_type: str,
+    cache_control: str,
+    extra_headers: Optional[Dict[str, str]] = None,
+) -> Optional[Response]:
+    """回傳預先壓縮的內容（或 304）；用戶端不接受任何可用編碼且沒有原始內容時回傳 None"""
+    encoding = pick_encoding(request_headers.get("accept-encoding", ""), asset.encodings)
+    if encoding is None and "identity" not in asset.encodings:
+        return None
+    etag = asset.variant_etag(encoding)
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding", **(extra_headers or {})}
+    if_none_match = request_headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(asset.encodings[encoding or "identity"], media_type=media_type, headers=headers)
+
+def static_cache_control(path: str) -> str:
+    return IMMUTABLE_CACHE_CONTROL if HASHED_ASSET_RE.search(path) else "no-cache"
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles 加上預先壓縮的內容與 Cache-Control
+    
+    有內容雜湊的檔名使用 immutable 長期快取，其他檔案 no-cache（每次以 ETag /
+    Last-Modified 重新驗證）。尚未壓縮或已在磁碟上變更的檔案退回一般 FileResponse。
+    """
+    
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        cache_control = static_cache_control(str(full_path))
+        asset = COMPRESSED_ASSETS.get(os.path.realpath(full_path))
+        if (
+            status_code == 200
+            and asset is not None
+            and asset.mtime == stat_result.st_mtime
+            and asset.size == stat_result.st_size
+        ):
+            response = compressed_asset_response(
+                Headers(scope=scope),
+                asset,
+                guess_type(str(full_path))[0] or "text/plain",
+                cache_control,
+                {"Last-Modified": formatdate(stat_result.st_mtime, usegmt=True)},
+            )
+            if response is not None:
+                return response
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers["Cache-Control"] = cache_control
+        if str(full_path).endswith(COMPRESSIBLE_SUFFIXES):
+            response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+app.mount("/static", PrecompressedStaticFiles(directory=STATIC_DIR), name="static")
 # 為了讓 Vite 建置的 assets 能正確被訪問，額外掛載 assets 資料夾
-app.mount("/assets", StaticFiles(directory="static/assets"), name="assets")
+app.mount("/assets", PrecompressedStaticFiles(directory=os.path.join(STATIC_DIR, "assets")), name="assets")
 
-# 簡單的記憶體 session：session_id -> {access_token, expires_at, refresh_token}
-SESSIONS: Dict[str, Dict] = {}
+# session 與 OAuth state 的存活時間
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))
+OAUTH_STATE_TTL = float(os.getenv("OAUTH_STATE_TTL", "600"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
 
-# 存儲 OAuth state 的臨時字典
-OAUTH_STATES: Dict[str, float] = {}  # state -> timestamp
+class ExpiringMap:
+    """有到期時間的 dict，以 min-heap 索引到期時間，清理時只需 O(log n) 取出已到期項目
+    
+    更新到期時間時直接推入新的 heap 項目，舊項目在取出時比對後略過。
+    """
+    
+    def __init__(self):
+        self._data: Dict[str, Tuple[float, object]] = {}
+        self._heap: List[Tuple[float, str]] = []
+    
+    def set(self, key: str, value, expires_at: float):
+        self._data[key] = (expires_at, value)
+        heapq.heappush(self._heap, (expires_at, key))
+        if len(self._heap) > 2 * len(self._data) + 64:
+            # 過期的 heap 項目太多時重建
+            self._heap = [(exp, k) for k, (exp, _) in self._data.items()]
+            heapq.heapify(self._heap)
+    
+    def get(self, key: str):
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+    
+    def pop(self, key: str):
+        entry = self._data.pop(key, None)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+    
+    def sweep(self, now: float) -> int:
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self._heap)
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == expires_at:
+                del self._data[key]
+                removed += 1
+        return removed
+    
+    def __len__(self) -> int:
+        return len(self._data)
+
+class SessionStore(ABC):
+    """session（session_id -> {access_token, refresh_token, expires_at, ...}）與 OAuth state 的儲存介面
+    
+    session 每次 save 都會把到期時間往後延 SESSION_TTL（滑動過期）。
+    """
+    
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[Dict]:
+        ...
+    
+    @abstractmethod
+    def save(self, session_id: str, session: Dict):
+        ...
+    
+    @abstractmethod
+    def delete(self, session_id: str):
+        ...
+    
+    @abstractmethod
+    def count(self) -> int:
+        """未過期的 session 數（給 active_sessions 指標）"""
+    
+    @abstractmethod
+    def add_state(self, state: str):
+        ...
+    
+    @abstractmethod
+    def consume_state(self, state: str) -> bool:
+        """state 存在且未過期時刪除並回傳 True（只能使用一次）"""
+    
+    @abstractmethod
+    def sweep(self) -> int:
+        """清除過期的 session 與 state，回傳清除數量"""
+
+class MemorySessionStore(SessionStore):
+    """單一程序內的記憶體 session（只適用於單一 worker）"""
+    
+    def __init__(self):
+        self._sessions = ExpiringMap()
+        self._states = ExpiringMap()
+    
+    def get(self, session_id: str) -> Optional[Dict]:
+        return self._sessions.get(session_id)
+    
+    def save(self, session_id: str, session: Dict):
+        self._sessions.set(session_id, session, time.time() + SESSION_TTL)
+    
+    def delete(self, session_id: str):
+        self._sessions.pop(session_id)
+    
+    def count(self) -> int:
+        return len(self._sessions)
+    
+    def add_state(self, state: str):
+        self._states.set(state, True, time.time() + OAUTH_STATE_TTL)
+    
+    def consume_state(self, state: str) -> bool:
+        return self._states.pop(state) is not None
+    
+    def sweep(self) -> int:
+        now = time.time()
+        return self._sessions.sweep(now) + self._states.sweep(now)
+
+class SQLiteSessionStore(SessionStore):
+    """以 SQLite（WAL 模式）共用 session，讓同一台機器上的多個 uvicorn worker 共享登入狀態"""
+    
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS oauth_states (state TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS oauth_states_expires_at ON oauth_states (expires_at)")
+    
+    def get(self, session_id: str) -> Optional[Dict]:
+        row = self._db.execute(
+            "SELECT data FROM sessions WHERE id = ? AND expires_at > ?", (session_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def save(self, session_id: str, session: Dict):
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(session), time.time() + SESSION_TTL),
+        )
+    
+    def delete(self, session_id: str):
+        self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+    
+    def count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+    
+    def add_state(self, state: str):
+        self._db.execute(
+            "INSERT OR REPLACE INTO oauth_states (state, expires_at) VALUES (?, ?)",
+            (state, time.time() + OAUTH_STATE_TTL),
+        )
+    
+    def consume_state(self, state: str) -> bool:
+        # 單一 DELETE 陳述式是原子操作，多個 worker 之間 state 也只能被使用一次
+        cursor = self._db.execute(
+            "DELETE FROM oauth_states WHERE state = ? AND expires_at > ?", (state, time.time())
+        )
+        return cursor.rowcount > 0
+    
+    def sweep(self) -> int:
+        now = time.time()
+        removed = self._db.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+        removed += self._db.execute("DELETE FROM oauth_states WHERE expires_at <= ?", (now,)).rowcount
+        return removed
+
+def create_session_store() -> SessionStore:
+    backend = os.getenv("SESSION_STORE", "memory").lower()
+    if backend == "sqlite":
+        return SQLiteSessionStore(os.getenv("SESSION_DB", "sessions.db"))
+    if WEB_WORKERS > 1:
+        # 各 worker 的記憶體 session / OAuth state 互不相通，登入與 callback 會隨機失敗
+        raise RuntimeError(f"SESSION_STORE=memory cannot be shared by WEB_WORKERS={WEB_WORKERS} workers; set SESSION_STORE=sqlite")
+    return MemorySessionStore()
+
+SESSION_STORE = create_session_store()
+
+def save_session(session: Dict):
+    """把修改過的 session（例如刷新後的 token）寫回 store"""
+    if session.get("id"):
+        SESSION_STORE.save(session["id"], session)
+
+async def sweep_expired_sessions():
+    """定期清除過期的 session，順便清理收藏快照、快取與分析結果中過期的項目"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            removed = SESSION_STORE.sweep()
+            if removed:
+                logger.debug("swept expired sessions", extra={"removed": removed})
+            ACTIVE_SESSIONS.set(SESSION_STORE.count())
+            removed = sweep_library_snapshots()
+            if removed:
+                logger.debug("swept library snapshots", extra={"removed": removed})
+            for cache in (ARTIST_GENRE_CACHE, AUDIO_FEATURE_CACHE):
+                removed = cache.sweep()
+                if removed:
+                    logger.debug("pruned cache rows", extra={"cache": cache.name, "removed": removed})
+            removed = ANALYSIS_FLIGHTS.sweep() + RESPONSE_CACHE.sweep()
+            if removed:
+                logger.debug("swept expired responses", extra={"removed": removed})
+        except Exception:
+            logger.exception("session sweep failed")
 
 def get_session_id(request: Request) -> str:
     """統一獲取 session ID 的輔助函數，支持 cookie 和 header"""
@@ -68,6 +1115,16 @@ def get_session_id(request: Request) -> str:
         session_id = request.headers.get("X-Session-ID")
     return session_id
 
+def get_session(request: Request) -> Tuple[Optional[str], Optional[Dict]]:
+    """取得 (session_id, session)；未登入或 session 已過期時 session 為 None"""
+    session_id = get_session_id(request)
+    if not session_id:
+        return session_id, None
+    session = SESSION_STORE.get(session_id)
+    if session is not None and ANALYSIS_REFRESH_INTERVAL > 0:
+        SESSION_LAST_SEEN[session_id] = time.monotonic()
+    return session_id, session
+
 # 更詳細的 genre -> major bucket 映射
 GENRE_BUCKET_MAP = {
     # Pop 相關
@@ -163,79 +1220,170 @@ GENRE_BUCKET_MAP = {
     "disco": "Disco",
 }
 
-def map_genre_to_bucket(genre: str) -> str:
-    """將音樂類型映射到主要分類，使用更智能的匹配邏輯"""
-    if not genre:
-        return "Unknown"
+# 子字符串匹配的關鍵字（按優先級排序）
+# 先匹配更具體的類型，再匹配通用的
+GENRE_PRIORITY_KEYWORDS = [
+    # 具體的電子音樂類型
+    ("house", "Electronic"), ("techno", "Electronic"), ("trance", "Electronic"),
+    ("dubstep", "Electronic"), ("drum and bass", "Electronic"), ("dnb", "Electronic"),
     
-    genre_lower = genre.lower().strip()
+    # 具體的搖滾類型
+    ("indie rock", "Rock"), ("alternative rock", "Rock"), ("punk rock", "Rock"),
+    ("hard rock", "Rock"), ("metal", "Metal"),
     
-    # 1. 精確匹配
-    if genre_lower in GENRE_BUCKET_MAP:
-        return GENRE_BUCKET_MAP[genre_lower]
+    # 具體的流行音樂
+    ("k-pop", "Pop"), ("j-pop", "Pop"), ("dance pop", "Pop"), ("indie pop", "Pop"),
     
-    # 2. 子字符串匹配（按優先級排序）
-    # 先匹配更具體的類型，再匹配通用的
-    priority_keywords = [
-        # 具體的電子音樂類型
-        ("house", "Electronic"), ("techno", "Electronic"), ("trance", "Electronic"),
-        ("dubstep", "Electronic"), ("drum and bass", "Electronic"), ("dnb", "Electronic"),
-        
-        # 具體的搖滾類型
-        ("indie rock", "Rock"), ("alternative rock", "Rock"), ("punk rock", "Rock"),
-        ("hard rock", "Rock"), ("metal", "Metal"),
-        
-        # 具體的流行音樂
-        ("k-pop", "Pop"), ("j-pop", "Pop"), ("dance pop", "Pop"), ("indie pop", "Pop"),
+    # Hip-Hop 相關
+    ("hip hop", "Hip-Hop"), ("hip-hop", "Hip-Hop"), ("rap", "Hip-Hop"),
+    
+    # R&B 相關  
+    ("r&b", "R&B"), ("soul", "R&B"), ("neo soul", "R&B"),
+    
+    # 其他具體類型
+    ("indie folk", "Folk"), ("folk rock", "Rock"), ("jazz fusion", "Jazz"),
+    ("smooth jazz", "Jazz"), ("country rock", "Country"), ("blues rock", "Blues"),
+    
+    # 通用匹配（放在最後）
+    ("electronic", "Electronic"), ("pop", "Pop"), ("rock", "Rock"), 
+    ("indie", "Indie"), ("folk", "Folk"), ("jazz", "Jazz"), 
+    ("blues", "Blues"), ("country", "Country"), ("classical", "Classical"),
+    ("latin", "Latin"), ("reggae", "Reggae"), ("alternative", "Alternative"),
+    ("chill", "Chill"), ("lo-fi", "Lo-Fi"), ("lofi", "Lo-Fi"),
+    ("ambient", "Electronic"), ("funk", "Funk"), ("disco", "Disco"),
+]
+
+class GenreClassifier:
+    """由 GENRE_BUCKET_MAP 與關鍵字優先序預先編譯的 genre 分類器
+    
+    所有關鍵字編譯成單一 regex（每個位置以 lookahead 比對各關鍵字），掃描一次
+    genre 字串即可找出優先序最高的命中關鍵字，語意與逐一檢查子字串相同。
+    結果以有上限的 memo 記住（滿了先淘汰最早加入的）；classify_many 把尚未記住的 genre 串成一段文字，
+    整批處理。
+    """
+    
+    def __init__(self, bucket_map: Dict[str, str], priority_keywords: List[Tuple[str, str]], memo_size: int = 4096):
+        self.bucket_map = dict(bucket_map)
+        self.keyword_buckets = [bucket for _, bucket in priority_keywords]
+        alternatives = "|".join(f"({re.escape(keyword)})" for keyword, _ in priority_keywords)
+        # 同一位置上 regex 會選擇最前面（優先序最高）的關鍵字，
+        # 因此所有位置中最小的群組編號就是整體優先序最高的命中
+        self._pattern = re.compile(f"(?=(?:{alternatives}))")
+        # 批次分類用：每個關鍵字各自的字面比對（整批文字只需各掃一次）
+        self._keyword_patterns = [re.compile(re.escape(keyword)) for keyword, _ in priority_keywords]
+        self.memo_size = memo_size
+        # 命中時只做一次 dict 查詢；聚合可能在 thread pool 中進行，寫入與淘汰需要加鎖
+        self._memo: Dict[str, str] = {}
+        self._memo_lock = threading.Lock()
+    
+    def _remember(self, genre: str, bucket: str):
+        with self._memo_lock:
+            self._memo[genre] = bucket
+            while len(self._memo) > self.memo_size:
+                del self._memo[next(iter(self._memo))]
+    
+    def _exact_or_none(self, genre: str, genre_lower: str) -> Optional[str]:
+        """不需要關鍵字比對就能決定的分類：空字串或精確匹配"""
+        if not genre:
+            return "Unknown"
+        return self.bucket_map.get(genre_lower)
+    
+    @staticmethod
+    def _fallback(genre: str) -> str:
+        # 如果都沒匹配到，返回原始類型（首字母大寫），避免全部歸類為 "Other"
+        return genre.title() if len(genre) <= 15 else "Other"
+    
+    def classify(self, genre: str) -> str:
+        bucket = self._memo.get(genre)
+        if bucket is not None:
+            return bucket
         
-        # Hip-Hop 相關
-        ("hip hop", "Hip-Hop"), ("hip-hop", "Hip-Hop"), ("rap", "Hip-Hop"),
+        genre_lower = genre.lower().strip()
         
-        # R&B 相關  
-        ("r&b", "R&B"), ("soul", "R&B"), ("neo soul", "R&B"),
+        # 1. 精確匹配
+        bucket = self._exact_or_none(genre, genre_lower)
+        if bucket is None:
+            # 2. 子字符串匹配（取優先序最高的關鍵字）
+            best = None
+            for match in self._pattern.finditer(genre_lower):
+                priority = match.lastindex - 1
+                if best is None or priority < best:
+                    best = priority
+                    if best == 0:
+                        break
+            # 3. 都沒匹配到時保留原始類型
+            bucket = self.keyword_buckets[best] if best is not None else self._fallback(genre)
+        self._remember(genre, bucket)
+        return bucket
+    
+    def classify_many(self, genres: List[str]) -> List[str]:
+        """批次分類，結果與逐一呼叫 classify 相同
         
-        # 其他具體類型
-        ("indie folk", "Folk"), ("folk rock", "Rock"), ("jazz fusion", "Jazz"),
-        ("smooth jazz", "Jazz"), ("country rock", "Country"), ("blues rock", "Blues"),
+        相同的 genre 只處理一次；memo 未命中且不是精確匹配的 genre 以換行串成一段
+        文字，每個關鍵字對整段文字做一次字面搜尋（比逐字元嘗試所有關鍵字的
+        lookahead regex 快得多），命中位置以 searchsorted 歸回各 genre，再用
+        np.minimum.at 取各自優先序最高的關鍵字。
+        """
+        buckets: Dict[str, Optional[str]] = dict.fromkeys(genres)
+        pending: List[str] = []
+        pending_lower: List[str] = []
+        for genre in buckets:
+            bucket = self._memo.get(genre)
+            if bucket is None:
+                genre_lower = genre.lower().strip()
+                bucket = self._exact_or_none(genre, genre_lower)
+                if bucket is None:
+                    pending.append(genre)
+                    pending_lower.append(genre_lower)
+                    continue
+                self._remember(genre, bucket)
+            buckets[genre] = bucket
         
-        # 通用匹配（放在最後）
-        ("electronic", "Electronic"), ("pop", "Pop"), ("rock", "Rock"), 
-        ("indie", "Indie"), ("folk", "Folk"), ("jazz", "Jazz"), 
-        ("blues", "Blues"), ("country", "Country"), ("classical", "Classical"),
-        ("latin", "Latin"), ("reggae", "Reggae"), ("alternative", "Alternative"),
-        ("chill", "Chill"), ("lo-fi", "Lo-Fi"), ("lofi", "Lo-Fi"),
-        ("ambient", "Electronic"), ("funk", "Funk"), ("disco", "Disco"),
-    ]
-    
-    # 按優先級匹配
-    for keyword, bucket in priority_keywords:
-        if keyword in genre_lower:
-            return bucket
-    
-    # 3. 如果都沒匹配到，返回原始類型（首字母大寫）
-    # 避免全部歸類為 "Other"
-    return genre.title() if len(genre) <= 15 else "Other"
+        if pending:
+            # 關鍵字不含換行，命中不會跨越兩個 genre
+            text = "\n".join(pending_lower)
+            starts = np.cumsum([0] + [len(g) + 1 for g in pending_lower[:-1]])
+            best = np.full(len(pending), len(self.keyword_buckets), dtype=np.intp)
+            for priority, pattern in enumerate(self._keyword_patterns):
+                positions = [m.start() for m in pattern.finditer(text)]
+                if positions:
+                    owners = np.searchsorted(starts, positions, side="right") - 1
+                    np.minimum.at(best, owners, priority)
+            for genre, priority in zip(pending, best.tolist()):
+                bucket = self.keyword_buckets[priority] if priority < len(self.keyword_buckets) else self._fallback(genre)
+                buckets[genre] = bucket
+                self._remember(genre, bucket)
+        return [buckets[genre] for genre in genres]
+
+GENRE_CLASSIFIER = GenreClassifier(
+    GENRE_BUCKET_MAP,
+    GENRE_PRIORITY_KEYWORDS,
+    memo_size=int(os.getenv("GENRE_MEMO_SIZE", "4096")),
+)
+
+def map_genre_to_bucket(genre: str) -> str:
+    """將音樂類型映射到主要分類，使用更智能的匹配邏輯"""
+    return GENRE_CLASSIFIER.classify(genre)
+
+# index.html 第一次請求時讀入記憶體，之後不再讀取檔案
+INDEX_PAGE: Optional[CompressedAsset] = None
 
 @app.get("/", response_class=HTMLResponse)
-async def index():
-    path = "static/index.html"
-    if os.path.exists(path):
-        return FileResponse(path)
-    else:
-        return HTMLResponse("<h1>index.html not found</h1>", status_code=404)
+async def index(request: Request):
+    global INDEX_PAGE
+    if INDEX_PAGE is None:
+        path = os.path.join(STATIC_DIR, "index.html")
+        if not os.path.exists(path):
+            return HTMLResponse("<h1>index.html not found</h1>", status_code=404)
+        INDEX_PAGE = load_static_asset(path, include_identity=True)
+    return compressed_asset_response(request.headers, INDEX_PAGE, "text/html; charset=utf-8", "no-cache")
 
 @app.get("/login")
 async def login(response: Response):
     state = str(uuid.uuid4())
     
-    # 將 state 存儲在後端內存中，而不是依賴 cookie
-    OAUTH_STATES[state] = time.time()
-    
-    # 清理過期的 states (超過10分鐘)
-    current_time = time.time()
-    expired_states = [s for s, t in OAUTH_STATES.items() if current_time - t > 600]
-    for s in expired_states:
-        del OAUTH_STATES[s]
+    # 將 state 存儲在後端 session store 中，而不是依賴 cookie（過期的 state 由背景清理）
+    SESSION_STORE.add_state(state)
     
     params = {
         "response_type": "code",
@@ -246,7 +1394,7 @@ async def login(response: Response):
         "show_dialog": "false",
     }
     auth_url = "https://accounts.spotify.com/authorize?" + urlencode(params)
-    print(f"DEBUG - Setting state in memory: {state}")
+    logger.debug("oauth login started")
     return RedirectResponse(auth_url)
 
 @app.get("/callback")
@@ -255,27 +1403,15 @@ async def callback(request: Request, code: str = None, state: str = None, error:
     if error:
         return HTMLResponse(f"<h3>Spotify 登入錯誤: {error}</h3>")
     
-    # 檢查 state 是否存在於後端存儲中
-    print(f"DEBUG - Received state: {state}")
-    print(f"DEBUG - Stored states: {list(OAUTH_STATES.keys())}")
-    
-    if state not in OAUTH_STATES:
+    # 檢查 state 是否存在於後端存儲中且未過期 (10分鐘)，使用後即刪除
+    if not state or not SESSION_STORE.consume_state(state):
         raise HTTPException(status_code=400, detail="invalid or expired state")
     
-    # 驗證 state 沒有過期 (10分鐘)
-    if time.time() - OAUTH_STATES[state] > 600:
-        del OAUTH_STATES[state]
-        raise HTTPException(status_code=400, detail="state expired")
-    
-    # 使用後刪除 state
-    del OAUTH_STATES[state]
-    
     # 交換 token
     token_url = "https://accounts.spotify.com/api/token"
     data = {"grant_type": "authorization_code", "code": code, "redirect_uri": REDIRECT_URI}
     auth = httpx.BasicAuth(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
-    async with httpx.AsyncClient(timeout=15.0) as client:
-        r = await client.post(token_url, data=data, auth=auth)
+    r = await spotify_request("POST", token_url, data=data, auth=auth, timeout=15.0, priority=PRIORITY_INTERACTIVE)
     if r.status_code != 200:
         raise HTTPException(status_code=400, detail="token exchange failed")
     token_json = r.json()
@@ -286,11 +1422,17 @@ async def callback(request: Request, code: str = None, state: str = None, error:
 
     # 建立 session
     session_id = str(uuid.uuid4())
-    SESSIONS[session_id] = {
+    session = {
+        "id": session_id,
         "access_token": access_token,
         "refresh_token": refresh_token,
         "expires_at": expires_at,
     }
+    SESSION_STORE.save(session_id, session)
+    TOKEN_MANAGER.track(session)
+    # 趁使用者被導回前端時就在背景開始分析，第一次載入 dashboard 可直接取得或等待同一個結果
+    if ANALYSIS_PREWARM:
+        spawn_background(prewarm_analysis(session_id, session))
 
     # 動態判斷前端 URL - 根據環境決定重新導向位置
     frontend_url = os.getenv("FRONTEND_URL")
@@ -316,274 +1458,1848 @@ async def callback(request: Request, code: str = None, state: str = None, error:
         secure="https" in frontend_url,  # HTTPS 環境下啟用 secure
         samesite="lax"
     )
-    print(f"DEBUG - Frontend URL: {frontend_url}")
-    print(f"DEBUG - Setting session cookie: {session_id}")
-    print(f"DEBUG - Redirecting with session in URL")
+    logger.info("login succeeded", extra={"frontend_url": frontend_url})
     return response
 
-async def refresh_token_if_needed(session: Dict):
-    if time.time() > session["expires_at"] - 60:  # expire soon
-        token_url = "https://accounts.spotify.com/api/token"
-        data = {"grant_type": "refresh_token", "refresh_token": session["refresh_token"]}
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+# 到期前多久在背景刷新 access token，再加上 0 ~ JITTER 秒的隨機提前量，避免大量 session 同時刷新
+TOKEN_REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+TOKEN_REFRESH_JITTER = float(os.getenv("TOKEN_REFRESH_JITTER", "120"))
+# 背景刷新失敗（網路或 Spotify 暫時錯誤）時的重試間隔
+TOKEN_REFRESH_RETRY = float(os.getenv("TOKEN_REFRESH_RETRY", "30"))
+# 最後一次使用超過這段時間的 session 不再於背景續期，下次請求時才刷新
+TOKEN_KEEPALIVE_WINDOW = float(os.getenv("TOKEN_KEEPALIVE_WINDOW", "1800"))
+# 剩餘效期少於這個秒數時，請求才需要等待刷新完成
+TOKEN_EXPIRY_SAFETY = 30.0
+
+class TokenManager:
+    """管理各 session 的 access token 生命週期
+    
+    使用中的 session 會排程在到期前（TOKEN_REFRESH_MARGIN 加上隨機抖動）於背景刷新，
+    請求處理只在 token 真的即將過期時才需要等待。同一個 session 的並發刷新合併成
+    一次 POST，並套用 Spotify 輪替後的新 refresh_token。refresh_token 被拒絕
+    （使用者撤銷授權）時拋出 401。
+    """
+    
+    def __init__(self, margin: float, jitter: float, keepalive: float):
+        self.margin = margin
+        self.jitter = jitter
+        self.keepalive = keepalive
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._last_seen: Dict[str, float] = {}
+    
+    async def ensure_fresh(self, session: Dict):
+        """確保 session 的 access token 可用；只有即將過期時才會等待刷新"""
+        self.track(session)
+        if time.time() < session["expires_at"] - TOKEN_EXPIRY_SAFETY:
+            return
+        await self.refresh(session)
+    
+    def track(self, session: Dict):
+        """記錄 session 正在使用中，並確保已排程背景刷新"""
+        session_id = session["id"]
+        self._last_seen[session_id] = time.monotonic()
+        if session_id not in self._timers:
+            self._schedule(session_id, session["expires_at"] - self.margin - random.uniform(0, self.jitter) - time.time())
+    
+    def _schedule(self, session_id: str, delay: float):
+        loop = asyncio.get_running_loop()
+        self._timers[session_id] = loop.call_later(max(0.0, delay), self._on_timer, session_id)
+    
+    def _on_timer(self, session_id: str):
+        self._timers.pop(session_id, None)
+        if time.monotonic() - self._last_seen.get(session_id, 0.0) > self.keepalive:
+            # 閒置的 session 不再續期
+            self._last_seen.pop(session_id, None)
+            return
+        session = SESSION_STORE.get(session_id)
+        if session is not None:
+            spawn_background(self._background_refresh(session))
+    
+    async def _background_refresh(self, session: Dict):
+        try:
+            await self.refresh(session)
+        except HTTPException as e:
+            if e.status_code == 401:
+                logger.info("refresh token rejected, session needs to log in again")
+                return
+            logger.warning("background token refresh failed", extra={"status": e.status_code})
+            self._schedule(session["id"], TOKEN_REFRESH_RETRY)
+            return
+        self.track(session)
+    
+    async def refresh(self, session: Dict):
+        """刷新 session 的 token；同一個 session 同時只會送出一個刷新請求"""
+        session_id = session["id"]
+        task = self._refreshing.get(session_id)
+        joined = task is not None
+        if task is None:
+            task = asyncio.create_task(self._refresh(session))
+            self._refreshing[session_id] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(session_id, None))
+        try:
+            # shield：某個等待者被取消時不影響其他人共用的刷新
+            tokens, reused = await asyncio.shield(task)
+        except HTTPException as e:
+            TOKEN_REFRESHES.labels("rejected" if e.status_code == 401 else "failed").inc()
+            raise
+        TOKEN_REFRESHES.labels("joined" if joined else "reused" if reused else "refreshed").inc()
+        session.update(tokens)
+    
+    async def _refresh(self, session: Dict) -> Tuple[Dict, bool]:
+        """送出刷新請求，回傳 (tokens, 是否沿用其他 worker 已刷新的 token)"""
+        # 其他 worker 已經刷新過（共用 SQLite session store 時，store 中的到期時間比手上這份新）
+        stored = SESSION_STORE.get(session["id"]) or session
+        if stored["expires_at"] > session["expires_at"]:
+            return {key: stored[key] for key in ("access_token", "refresh_token", "expires_at")}, True
+        data = {"grant_type": "refresh_token", "refresh_token": stored["refresh_token"]}
         auth = httpx.BasicAuth(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            r = await client.post(token_url, data=data, auth=auth)
-        if r.status_code == 200:
-            j = r.json()
-            session["access_token"] = j["access_token"]
-            session["expires_at"] = time.time() + j.get("expires_in", 3600)
+        try:
+            r = await spotify_request("POST", TOKEN_URL, data=data, auth=auth, timeout=15.0, priority=PRIORITY_INTERACTIVE)
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=503, detail="token refresh failed") from e
+        if r.status_code in (400, 401):
+            # invalid_grant：refresh token 已失效或被撤銷
+            raise HTTPException(status_code=401, detail="session expired, please log in again")
+        if r.status_code != 200:
+            raise HTTPException(status_code=503, detail="token refresh failed")
+        j = decode_json(r.content)
+        tokens = {
+            "access_token": j["access_token"],
+            # Spotify 可能輪替 refresh token；沒有回傳新的就沿用舊的
+            "refresh_token": j.get("refresh_token") or stored["refresh_token"],
+            "expires_at": time.time() + j.get("expires_in", 3600),
+        }
+        save_session({**stored, **tokens})
+        return tokens, False
+    
+    def close(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+TOKEN_MANAGER = TokenManager(TOKEN_REFRESH_MARGIN, TOKEN_REFRESH_JITTER, TOKEN_KEEPALIVE_WINDOW)
+
+def drop_session(session_id: str):
+    """刪除 session 及其快取的回應（例如 refresh token 已失效時）"""
+    SESSION_STORE.delete(session_id)
+    RESPONSE_CACHE.invalidate_session(session_id)
+
+SAVED_TRACKS_URL = "https://api.spotify.com/v1/me/tracks"
+SAVED_TRACKS_PAGE_SIZE = 50
+# 收藏歌曲分頁的並行抓取上限；設為 1 則退回逐頁循序抓取
+SAVED_TRACKS_CONCURRENCY = int(os.getenv("SAVED_TRACKS_CONCURRENCY", "8"))
+
+def decode_json(content: bytes):
+    """解析 Spotify 回應內容；有安裝 orjson 時使用較快的解析器"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def encode_json(payload) -> bytes:
+    """序列化成 UTF-8 JSON，輸出與 JSONResponse 相同（不跳脫非 ASCII、沒有多餘空白）"""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+def track_key(item: Dict) -> Optional[str]:
+    """收藏歌曲的識別 key；本地檔案沒有 track id，改用 uri"""
+    track = item.get("track") or {}
+    return track.get("id") or track.get("uri")
 
-async def fetch_user_saved_tracks(access_token: str) -> List[Dict]:
-    # fetch all saved tracks (limit 50 per request)
-    url = "https://api.spotify.com/v1/me/tracks"
+class SavedTrack:
+    """收藏歌曲的精簡投影，只保留分析用到的欄位
+    
+    Spotify 每筆收藏都附帶完整的專輯、圖片與 available_markets，分析只需要
+    歌曲 key、藝人 ID 與加入時間。ID 以 sys.intern 共用，同一位藝人出現在
+    多首歌或多位使用者的快照時只佔一份字串。
+    """
+    
+    __slots__ = ("key", "artist_ids", "added_at")
+    
+    def __init__(self, key: str, artist_ids: Tuple[str, ...], added_at: Optional[str]):
+        self.key = key
+        self.artist_ids = artist_ids
+        self.added_at = added_at
+    
+    def __repr__(self) -> str:
+        return f"SavedTrack({self.key!r}, {self.artist_ids!r}, {self.added_at!r})"
+
+def project_saved_tracks(items: List[Dict]) -> List[SavedTrack]:
+    """把一頁原始收藏項目投影成 SavedTrack，略過沒有識別 key 的項目"""
+    out = []
+    for item in items:
+        key = track_key(item)
+        if key is None:
+            continue
+        artists = (item.get("track") or {}).get("artists") or []
+        artist_ids = tuple(sys.intern(a["id"]) for a in artists if a.get("id"))
+        out.append(SavedTrack(sys.intern(key), artist_ids, item.get("added_at")))
+    return out
+
+async def fetch_saved_tracks_page(access_token: str, offset: int, limit: int = SAVED_TRACKS_PAGE_SIZE) -> Dict:
+    """抓取單一頁收藏歌曲，回傳 Spotify 原始 JSON（含 items / total / next）"""
     headers = {"Authorization": f"Bearer {access_token}"}
-    tracks = []
-    params = {"limit": 50, "offset": 0}
+    params = {"limit": limit, "offset": offset}
+    r = await spotify_request("GET", SAVED_TRACKS_URL, headers=headers, params=params, timeout=20.0, hedge=True)
+    TRACK_PAGES_FETCHED.inc()
+    logger.debug("saved tracks page", extra={"offset": offset, "status": r.status_code})
+    
+    if r.status_code == 401:
+        raise HTTPException(status_code=401, detail="access token invalid/expired")
+    elif r.status_code == 403:
+        logger.warning("saved tracks forbidden", extra={"body": r.text[:500]})
+        raise HTTPException(status_code=403, detail="Insufficient permissions. Please ensure your Spotify app has 'user-library-read' scope enabled.")
+    elif r.status_code != 200:
+        logger.warning("saved tracks unexpected status", extra={"status": r.status_code, "body": r.text[:500]})
+        raise HTTPException(status_code=r.status_code, detail=f"Spotify API error: {r.status_code}")
+    
+    try:
+        return decode_json(r.content)
+    except Exception as e:
+        logger.error("saved tracks invalid JSON", extra={"body": r.text[:500]})
+        raise HTTPException(status_code=500, detail=f"Invalid response from Spotify API: {str(e)}")
+
+async def iter_saved_track_pages(
+    access_token: str,
+    concurrency: Optional[int] = None,
+    resume: Optional["PartialLibrary"] = None,
+) -> AsyncIterator[Tuple[int, List[Dict], Optional[int]]]:
+    """依抵達順序逐頁產出 (offset, items, total)
+    
+    第一頁回傳 total 後，其餘 offset 會在 concurrency 上限內並行抓取；
+    concurrency <= 1 或沒有 total 時則沿用 next 連結逐頁抓取。
+    有 resume 時，上次中斷前已抓到且仍有效的分頁不再抓取，也不會產出。
+    """
+    if concurrency is None:
+        concurrency = SAVED_TRACKS_CONCURRENCY
+    limit = SAVED_TRACKS_PAGE_SIZE
+    
+    first = await fetch_saved_tracks_page(access_token, 0, limit)
+    items = first.get("items", [])
+    total = first.get("total")
+    if not items:
+        return
+    sequential = concurrency <= 1 or not isinstance(total, int)
+    skip = set()
+    if resume is not None:
+        if sequential:
+            # 逐頁抓取時無法跳過中間的分頁，直接重新抓取
+            resume.pages.clear()
+        else:
+            skip = resume.resumable_offsets(items, total)
+    yield 0, items, total
+    if first.get("next") is None:
+        return
     
-    async with httpx.AsyncClient(timeout=20.0) as client:
+    if sequential:
+        offset = limit
         while True:
-            print(f"DEBUG - Fetching saved tracks with params: {params}")
-            r = await client.get(url, headers=headers, params=params)
-            print(f"DEBUG - Spotify API response status: {r.status_code}")
-            
-            if r.status_code == 401:
-                raise HTTPException(status_code=401, detail="access token invalid/expired")
-            elif r.status_code == 403:
-                print(f"DEBUG - 403 Forbidden response: {r.text}")
-                raise HTTPException(status_code=403, detail="Insufficient permissions. Please ensure your Spotify app has 'user-library-read' scope enabled.")
-            elif r.status_code != 200:
-                print(f"DEBUG - Unexpected status code: {r.status_code}, response: {r.text}")
-                raise HTTPException(status_code=r.status_code, detail=f"Spotify API error: {r.status_code}")
-            
-            try:
-                j = r.json()
-            except Exception as e:
-                print(f"ERROR - Failed to parse JSON response: {r.text}")
-                raise HTTPException(status_code=500, detail=f"Invalid response from Spotify API: {str(e)}")
-            
+            j = await fetch_saved_tracks_page(access_token, offset, limit)
             items = j.get("items", [])
             if not items:
                 break
-            tracks.extend(items)
+            yield offset, items, total
             if j.get("next") is None:
                 break
-            params["offset"] += params["limit"]
+            offset += limit
+        return
     
-    return tracks
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def fetch_page(offset: int) -> Tuple[int, List[Dict]]:
+        async with semaphore:
+            j = await fetch_saved_tracks_page(access_token, offset, limit)
+        return offset, j.get("items", [])
+    
+    tasks = [asyncio.create_task(fetch_page(offset)) for offset in range(limit, total, limit) if offset not in skip]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            offset, items = await next_done
+            if items:
+                yield offset, items, total
+    finally:
+        # 任一頁失敗或呼叫端提早結束時，取消其餘尚未完成的分頁
+        for task in tasks:
+            task.cancel()
 
-async def fetch_artists_genres(access_token: str, artist_ids: List[str]) -> Dict[str, List[str]]:
-    # batch fetch artists (50 at a time)
-    headers = {"Authorization": f"Bearer {access_token}"}
-    base = "https://api.spotify.com/v1/artists"
-    out = {}
-    async with httpx.AsyncClient(timeout=20.0) as client:
-        for i in range(0, len(artist_ids), 50):
-            batch = artist_ids[i:i+50]
-            params = {"ids": ",".join(batch)}
-            r = await client.get(base, headers=headers, params=params)
-            if r.status_code != 200:
-                raise HTTPException(status_code=400, detail="artist fetch failed")
-            j = r.json()
-            for artist in j.get("artists", []):
-                out[artist["id"]] = artist.get("genres", [])
-    return out
+async def fetch_user_saved_tracks(access_token: str, concurrency: Optional[int] = None, compact: bool = False) -> List:
+    # fetch all saved tracks (limit 50 per request)，並依 offset 重新排回原本順序
+    # compact=True 時每頁抵達即投影成 SavedTrack，原始 JSON 不會累積在記憶體中
+    pages: Dict[int, List] = {}
+    async for offset, items, _ in iter_saved_track_pages(access_token, concurrency):
+        pages[offset] = project_saved_tracks(items) if compact else items
+    
+    tracks = []
+    for offset in sorted(pages):
+        tracks.extend(pages[offset])
+    return tracks
 
-@app.get("/api/analysis")
-async def analysis(request: Request):
-    try:
-        print(f"DEBUG - Analysis request started")
-        
-        session_id = get_session_id(request)
-        print(f"DEBUG - Analysis - Session ID: {session_id}")
-        
-        if not session_id or session_id not in SESSIONS:
-            print(f"DEBUG - Analysis - Session not found or invalid")
-            return JSONResponse({"error": "not_logged_in"}, status_code=401)
-        
-        session = SESSIONS[session_id]
-        print(f"DEBUG - Analysis - Session found, token expires at: {session['expires_at']}")
+class TTLCache:
+    """有大小上限（LRU 淘汰）與 TTL 的 key -> value 快取，可選擇以 SQLite 持久化
+    
+    記憶體層負責熱資料；設定 db_path 時，記憶體未命中的 key 會再查 SQLite，
+    讓快取在重啟後仍然有效，並可由多個 uvicorn worker 共用（WAL 模式）。
+    value 需可被 JSON 序列化。SQLite 的過期列由 sweep() 定期刪除，列數超過
+    db_max_rows 時先刪最早到期的。
+    """
+    
+    # SQLite 清理（COUNT 與 DELETE）的最短間隔秒數
+    DB_PRUNE_INTERVAL = 3600
+    
+    def __init__(self, name: str, maxsize: int, ttl: float, db_path: Optional[str] = None, db_max_rows: int = 0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.db_max_rows = db_max_rows
+        self.hits = 0
+        self.misses = 0
+        self._pruned_at = 0.0
+        self._data: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS {name}_expires_at ON {name} (expires_at)")
+    
+    def _remember(self, key: str, expires_at: float, value):
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def _load_from_db(self, keys: List[str], now: float) -> Dict[str, object]:
+        found = {}
+        if self._db is None or not keys:
+            return found
+        # SQLite 單一查詢的參數數量有限，分批查詢
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._db.execute(
+                f"SELECT key, value, expires_at FROM {self.name} WHERE key IN ({placeholders}) AND expires_at > ?",
+                (*chunk, now),
+            ).fetchall()
+            for key, value, expires_at in rows:
+                found[key] = json.loads(value)
+                self._remember(key, expires_at, found[key])
+        return found
+    
+    def get_many(self, keys: List[str]) -> Tuple[Dict[str, object], List[str]]:
+        """回傳 (命中的 key -> value, 未命中的 key 列表)，並更新命中/未命中計數"""
+        now = time.time()
+        found: Dict[str, object] = {}
+        missing: List[str] = []
+        for key in keys:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                found[key] = entry[1]
+            else:
+                if entry is not None:
+                    del self._data[key]
+                missing.append(key)
+        if missing and self._db is not None:
+            found.update(self._load_from_db(missing, now))
+            missing = [key for key in missing if key not in found]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        return found, missing
+    
+    def set_many(self, items: Dict[str, object]):
+        expires_at = time.time() + self.ttl
+        for key, value in items.items():
+            self._remember(key, expires_at, value)
+        if self._db is not None and items:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO {self.name} (key, value, expires_at) VALUES (?, ?, ?)",
+                [(key, json.dumps(value), expires_at) for key, value in items.items()],
+            )
+    
+    def sweep(self) -> int:
+        """移除過期項目並把 SQLite 列數限制在 db_max_rows 以內，回傳刪除的 SQLite 列數
         
-        await refresh_token_if_needed(session)
-        access_token = session["access_token"]
+        記憶體層每次都清；SQLite 最多每 DB_PRUNE_INTERVAL 秒清一次。
+        """
+        now = time.time()
+        expired = [key for key, (expires_at, _) in self._data.items() if expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        if self._db is None or now - self._pruned_at < self.DB_PRUNE_INTERVAL:
+            return 0
+        self._pruned_at = now
+        removed = self._db.execute(f"DELETE FROM {self.name} WHERE expires_at <= ?", (now,)).rowcount
+        if self.db_max_rows > 0:
+            (rows,) = self._db.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()
+            if rows > self.db_max_rows:
+                # 同一個 TTL 下最早到期的就是最早寫入的
+                removed += self._db.execute(
+                    f"DELETE FROM {self.name} WHERE key IN (SELECT key FROM {self.name} ORDER BY expires_at LIMIT ?)",
+                    (rows - self.db_max_rows,),
+                ).rowcount
+        return removed
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "persistent": self._db is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
 
-        print(f"DEBUG - Analysis - Fetching user saved tracks...")
-        tracks = await fetch_user_saved_tracks(access_token)
-        print(f"DEBUG - Analysis - Found {len(tracks)} saved tracks")
-        
-        if not tracks:
-            print(f"DEBUG - Analysis - No tracks found, returning empty result")
-            return {"total_tracks": 0, "buckets": {}, "top_genres": []}
-
-        # collect artist ids from saved tracks
-        artist_ids = []
-        for item in tracks:
-            track = item.get("track") or {}
-            artists = track.get("artists", [])
-            for a in artists:
-                artist_ids.append(a["id"])
-        # dedupe
-        artist_ids = list(dict.fromkeys(artist_ids))
-        print(f"DEBUG - Analysis - Found {len(artist_ids)} unique artists")
-
-        print(f"DEBUG - Analysis - Fetching artist genres...")
-        artist_genres = await fetch_artists_genres(access_token, artist_ids)
-        print(f"DEBUG - Analysis - Fetched genres for {len(artist_genres)} artists")
-
-        # count genre occurences (per artist)
-        genre_counts: Dict[str, int] = {}
-        unknown_artists = []  # 追蹤沒有 genres 的藝人
-        
-        for aid, genres in artist_genres.items():
-            if not genres:
-                genre_counts.setdefault("unknown", 0)
-                genre_counts["unknown"] += 1
-                # 記錄沒有 genres 的藝人（用於調試）
-                unknown_artists.append(aid)
-            for g in genres:
-                genre_counts[g] = genre_counts.get(g, 0) + 1
+# 跨使用者共用的 artist ID -> genres 快取（genres 屬於全域資料）
+ARTIST_GENRE_CACHE = TTLCache(
+    "artist_genres",
+    maxsize=int(os.getenv("ARTIST_CACHE_SIZE", "50000")),
+    ttl=float(os.getenv("ARTIST_CACHE_TTL", str(7 * 24 * 3600))),
+    db_path=os.getenv("ARTIST_CACHE_DB") or None,
+    db_max_rows=int(os.getenv("ARTIST_CACHE_DB_MAX_ROWS", "500000")),
+)
+
+ARTISTS_URL = "https://api.spotify.com/v1/artists"
+ARTIST_BATCH_SIZE = 50
+# 同時進行中的 /v1/artists 批次請求上限
+ARTIST_FETCH_CONCURRENCY = int(os.getenv("ARTIST_FETCH_CONCURRENCY", "4"))
+
+async def fetch_artists_batch(access_token: str, batch: List[str]) -> Dict[str, List[str]]:
+    """抓取單一批（最多 50 個）藝人的 genres"""
+    headers = {"Authorization": f"Bearer {access_token}"}
+    params = {"ids": ",".join(batch)}
+    r = await spotify_request("GET", ARTISTS_URL, headers=headers, params=params, timeout=20.0, hedge=True)
+    ARTIST_BATCHES_FETCHED.inc()
+    if r.status_code == 429:
+        raise HTTPException(
+            status_code=503,
+            detail="Spotify rate limit exceeded, please retry later",
+            headers={"Retry-After": r.headers.get("Retry-After", "30")},
+        )
+    if r.status_code != 200:
+        raise HTTPException(status_code=400, detail="artist fetch failed")
+    j = decode_json(r.content)
+    out = {}
+    for artist in j.get("artists", []):
+        if artist:
+            out[artist["id"]] = artist.get("genres", [])
+    ARTIST_GENRE_CACHE.set_many(out)
+    return out
+
+async def gather_cancel_on_error(tasks: List["asyncio.Task"]) -> List:
+    """等待所有 task 完成；任一個失敗時取消其餘 task 再拋出例外"""
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+async def fetch_artists_genres(access_token: str, artist_ids: List[str]) -> Dict[str, List[str]]:
+    # 先查快取，只有未命中的藝人才送到 /v1/artists
+    cached, missing = ARTIST_GENRE_CACHE.get_many(artist_ids)
+    # batch fetch artists (50 at a time)，批次之間並行送出
+    semaphore = asyncio.Semaphore(ARTIST_FETCH_CONCURRENCY)
+    
+    async def fetch_batch(batch: List[str]) -> Dict[str, List[str]]:
+        async with semaphore:
+            return await fetch_artists_batch(access_token, batch)
+    
+    tasks = [
+        asyncio.create_task(fetch_batch(missing[i:i+ARTIST_BATCH_SIZE]))
+        for i in range(0, len(missing), ARTIST_BATCH_SIZE)
+    ]
+    fetched = dict(cached)
+    for batch_result in await gather_cancel_on_error(tasks):
+        fetched.update(batch_result)
+    # 依傳入的藝人順序輸出，讓結果與逐批抓取時一致
+    return {aid: fetched[aid] for aid in artist_ids if aid in fetched}
+
+def collect_artist_ids(tracks: List[SavedTrack]) -> List[str]:
+    """依歌曲順序收集並去重藝人 ID"""
+    return list(dict.fromkeys(aid for track in tracks for aid in track.artist_ids))
+
+async def fetch_library_with_genres(
+    access_token: str,
+    progress: Optional["AnalysisProgress"] = None,
+    resume: Optional["PartialLibrary"] = None,
+) -> Tuple[List[SavedTrack], Dict[str, List[str]]]:
+    """以 producer/consumer 管線同時抓取收藏歌曲與藝人 genres
+    
+    每抵達一頁歌曲就投影成 SavedTrack 並把新出現的藝人 ID 排入佇列，湊滿 50 個
+    立即送出 /v1/artists 批次，因此藝人查詢會與後續分頁下載重疊進行。
+    progress 會在每頁歌曲與每批藝人完成時收到通知。
+    
+    抓到的分頁直接存進 resume.pages，逾時或失敗時保留下來，下次同步從中斷處接續
+    （已完成的藝人批次則留在 ARTIST_GENRE_CACHE）。
+    """
+    semaphore = asyncio.Semaphore(ARTIST_FETCH_CONCURRENCY)
+    pages: Dict[int, List[SavedTrack]] = resume.pages if resume is not None else {}
+    seen_artists = set()
+    fetched: Dict[str, List[str]] = {}
+    pending: List[str] = []
+    batch_tasks: List[asyncio.Task] = []
+    
+    async def fetch_batch(batch: List[str]) -> Dict[str, List[str]]:
+        async with semaphore:
+            batch_result = await fetch_artists_batch(access_token, batch)
+        if progress is not None:
+            progress.artists_resolved(batch_result)
+        return batch_result
+    
+    def dispatch(batch: List[str]):
+        batch_tasks.append(asyncio.create_task(fetch_batch(batch)))
+    
+    def accept(offset: int, page: List[SavedTrack], item_count: int, total: Optional[int]):
+        nonlocal pending
+        pages[offset] = page
+        new_artists = [aid for aid in collect_artist_ids(page) if aid not in seen_artists]
+        seen_artists.update(new_artists)
+        cached, missing = ARTIST_GENRE_CACHE.get_many(new_artists)
+        fetched.update(cached)
+        pending.extend(missing)
+        if progress is not None:
+            progress.page_fetched(item_count, total)
+            progress.artists_resolved(cached)
+        while len(pending) >= ARTIST_BATCH_SIZE:
+            dispatch(pending[:ARTIST_BATCH_SIZE])
+            pending = pending[ARTIST_BATCH_SIZE:]
+    
+    try:
+        with phase_timer("track_fetch"):
+            async for offset, items, total in iter_saved_track_pages(access_token, resume=resume):
+                # 只保留投影結果，原始頁面 JSON 在這之後即可被回收
+                accept(offset, project_saved_tracks(items), len(items), total)
+                if offset == 0 and len(pages) > 1:
+                    # 第一頁確認過收藏庫沒變，沿用上次中斷前抓到的分頁
+                    for resumed in sorted(pages)[1:]:
+                        accept(resumed, pages[resumed], len(pages[resumed]), total)
+        if pending:
+            dispatch(pending)
+        # 只計算最後一頁歌曲之後仍在等待藝人批次的時間
+        with phase_timer("artist_fetch"):
+            batch_results = await gather_cancel_on_error(batch_tasks)
+    except BaseException:
+        for task in batch_tasks:
+            task.cancel()
+        raise
+    
+    tracks = []
+    for offset in sorted(pages):
+        tracks.extend(pages[offset])
+    
+    for batch_result in batch_results:
+        fetched.update(batch_result)
+    # 分頁可能亂序抵達，依歌曲順序重建藝人順序，確保結果與循序抓取一致
+    artist_genres = {aid: fetched[aid] for aid in collect_artist_ids(tracks) if aid in fetched}
+    return tracks, artist_genres
+
+# 音訊特徵分析：能量、情緒（valence）、可舞性與節奏的分佈
+# 預設關閉：2024 年底之後註冊的 Spotify app 呼叫 /v1/audio-features 會得到 403
+AUDIO_FEATURES_ENABLED = env_flag("AUDIO_FEATURES", False)
+# 收到 403 後設為 True，之後不再向 Spotify 查詢音訊特徵（直到服務重啟）
+AUDIO_FEATURES_FORBIDDEN = False
+AUDIO_FEATURES_URL = "https://api.spotify.com/v1/audio-features"
+AUDIO_FEATURE_BATCH_SIZE = 100
+AUDIO_FEATURE_FETCH_CONCURRENCY = int(os.getenv("AUDIO_FEATURE_FETCH_CONCURRENCY", "4"))
+# 音訊特徵階段的時間預算（秒），逾時就略過特徵，不拖住整個分析
+AUDIO_FEATURES_DEADLINE = float(os.getenv("AUDIO_FEATURES_DEADLINE", "60"))
+AUDIO_FEATURE_FIELDS = ("energy", "valence", "danceability", "tempo")
+# 各特徵的直方圖邊界；tempo 超出範圍的值歸入最外側的區間
+AUDIO_FEATURE_BINS = {
+    "energy": np.linspace(0.0, 1.0, 11),
+    "valence": np.linspace(0.0, 1.0, 11),
+    "danceability": np.linspace(0.0, 1.0, 11),
+    "tempo": np.arange(60.0, 201.0, 10.0),
+}
+AUDIO_FEATURE_PERCENTILES = (10, 25, 50, 75, 90)
+MISSING_AUDIO_FEATURES = (float("nan"),) * len(AUDIO_FEATURE_FIELDS)
+
+# 跨使用者共用的 track ID -> 音訊特徵快取；特徵不會變動，TTL 可以設得很長
+AUDIO_FEATURE_CACHE = TTLCache(
+    "audio_features",
+    maxsize=int(os.getenv("AUDIO_FEATURE_CACHE_SIZE", "200000")),
+    ttl=float(os.getenv("AUDIO_FEATURE_CACHE_TTL", str(30 * 24 * 3600))),
+    db_path=os.getenv("AUDIO_FEATURE_CACHE_DB") or None,
+    db_max_rows=int(os.getenv("AUDIO_FEATURE_CACHE_DB_MAX_ROWS", "1000000")),
+)
+
+async def fetch_audio_features_batch(access_token: str, batch: List[str]) -> Dict[str, Optional[List[float]]]:
+    """抓取單一批（最多 100 首）歌曲的音訊特徵；Spotify 沒有特徵的歌曲記為 None"""
+    headers = {"Authorization": f"Bearer {access_token}"}
+    params = {"ids": ",".join(batch)}
+    # 音訊特徵是選用端點，它的故障不該讓共用的 api.spotify.com 熔斷器擋下其他請求
+    r = await spotify_request("GET", AUDIO_FEATURES_URL, headers=headers, params=params, timeout=20.0, hedge=True, circuit_breaker=False)
+    AUDIO_FEATURE_BATCHES_FETCHED.inc()
+    if r.status_code == 429:
+        raise HTTPException(
+            status_code=503,
+            detail="Spotify rate limit exceeded, please retry later",
+            headers={"Retry-After": r.headers.get("Retry-After", "30")},
+        )
+    if r.status_code != 200:
+        raise HTTPException(status_code=r.status_code, detail="audio features fetch failed")
+    j = decode_json(r.content)
+    out: Dict[str, Optional[List[float]]] = dict.fromkeys(batch)
+    for features in j.get("audio_features") or []:
+        if features:
+            out[features["id"]] = [
+                float(value) if value is not None else float("nan")
+                for value in (features.get(name) for name in AUDIO_FEATURE_FIELDS)
+            ]
+    AUDIO_FEATURE_CACHE.set_many(out)
+    return out
+
+async def fetch_audio_features(access_token: str, track_keys: List[str]) -> np.ndarray:
+    """回傳與 track_keys 對齊的 (n, 4) float32 特徵陣列，缺少特徵的歌曲整列為 NaN
+    
+    本地檔案（key 為 uri）沒有特徵，不會送出查詢；快取未命中的 ID 以每批 100 個並行抓取。
+    """
+    track_ids = [key for key in track_keys if ":" not in key]
+    cached, missing = AUDIO_FEATURE_CACHE.get_many(track_ids)
+    semaphore = asyncio.Semaphore(AUDIO_FEATURE_FETCH_CONCURRENCY)
+    
+    async def fetch_batch(batch: List[str]) -> Dict[str, Optional[List[float]]]:
+        async with semaphore:
+            return await fetch_audio_features_batch(access_token, batch)
+    
+    tasks = [
+        asyncio.create_task(fetch_batch(missing[i:i+AUDIO_FEATURE_BATCH_SIZE]))
+        for i in range(0, len(missing), AUDIO_FEATURE_BATCH_SIZE)
+    ]
+    features = dict(cached)
+    for batch_result in await gather_cancel_on_error(tasks):
+        features.update(batch_result)
+    rows = [features.get(key) or MISSING_AUDIO_FEATURES for key in track_keys]
+    return np.array(rows, dtype=np.float32).reshape(len(track_keys), len(AUDIO_FEATURE_FIELDS))
+
+def summarize_audio_features(features: Optional[np.ndarray]) -> Optional[Dict]:
+    """各特徵的平均、百分位數與直方圖，整欄以 NumPy 計算；NaN（缺少特徵）不列入"""
+    if features is None:
+        return None
+    summary = {}
+    for column, name in enumerate(AUDIO_FEATURE_FIELDS):
+        values = features[:, column]
+        values = values[~np.isnan(values)].astype(np.float64)
+        edges = AUDIO_FEATURE_BINS[name]
+        if not len(values):
+            summary[name] = {"mean": None, "percentiles": {}, "histogram": {"edges": edges.tolist(), "counts": [0] * (len(edges) - 1)}}
+            continue
+        counts, _ = np.histogram(np.clip(values, edges[0], edges[-1]), bins=edges)
+        percentiles = np.percentile(values, AUDIO_FEATURE_PERCENTILES)
+        summary[name] = {
+            "mean": round(float(values.mean()), 4),
+            "percentiles": {f"p{p}": round(float(v), 4) for p, v in zip(AUDIO_FEATURE_PERCENTILES, percentiles)},
+            "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+        }
+    return {
+        "tracks": int(np.count_nonzero(~np.isnan(features).all(axis=1))),
+        "features": summary,
+    }
+
+def merge_small_buckets(artist_bucket_counts: Dict[str, int]) -> Dict[str, int]:
+    """合併佔比過小的分類，並把分類數量限制在 10 個以內"""
+    # 合併相似的分類並限制數量
+    final_buckets = {}
+    artist_total = sum(artist_bucket_counts.values())
+    min_count_threshold = max(1, artist_total * 0.02)  # 至少佔 2%
+    
+    for bucket, count in artist_bucket_counts.items():
+        if count >= min_count_threshold:
+            final_buckets[bucket] = count
+        else:
+            # 將小分類合併到 "Other"
+            final_buckets["Other"] = final_buckets.get("Other", 0) + count
+    
+    # 如果分類太多（超過10個），合併最小的幾個
+    if len(final_buckets) > 10:
+        sorted_buckets = sorted(final_buckets.items(), key=lambda x: x[1], reverse=True)
+        main_buckets = dict(sorted_buckets[:9])  # 保留前9個
+        other_count = sum(count for _, count in sorted_buckets[9:])  # 其餘合併
+        if other_count > 0:
+            main_buckets["Other"] = other_count
+        final_buckets = main_buckets
+    return final_buckets
+
+def name_ranks(names: List[str]) -> np.ndarray:
+    """每個名稱依字母順序的名次，作為同次數時的排序依據"""
+    ranks = np.empty(len(names), dtype=np.intp)
+    ranks[sorted(range(len(names)), key=names.__getitem__)] = np.arange(len(names))
+    return ranks
+
+def top_counts(counts: np.ndarray, n: int, ranks: Optional[np.ndarray] = None) -> np.ndarray:
+    """回傳次數最高的 n 個索引；同次數時 ranks 較小的在前（未指定時依索引）"""
+    if len(counts) <= n:
+        candidates = np.arange(len(counts))
+    else:
+        # argpartition 只保證第 n 名的位置；把與第 n 名同次數的也納入，並列時才不會漏掉排序較前者
+        kth = counts[np.argpartition(-counts, n - 1)[n - 1]]
+        candidates = np.flatnonzero(counts >= kth)
+    tiebreak = candidates if ranks is None else ranks[candidates]
+    order = np.lexsort((tiebreak, -counts[candidates]))
+    return candidates[order][:n]
+
+# genre 共現圖與分群：只取藝人數最多的前 N 個 genre，階層式分群在 cosine 距離門檻處切開
+GENRE_GRAPH_ENABLED = env_flag("GENRE_GRAPH", True)
+GENRE_GRAPH_MAX_GENRES = int(os.getenv("GENRE_GRAPH_MAX_GENRES", "200"))
+GENRE_GRAPH_TOP_PAIRS = int(os.getenv("GENRE_GRAPH_TOP_PAIRS", "20"))
+GENRE_CLUSTER_DISTANCE = float(os.getenv("GENRE_CLUSTER_DISTANCE", "0.7"))
+GENRE_CLUSTER_MAX = int(os.getenv("GENRE_CLUSTER_MAX", "10"))
+# 不是真正 genre 的佔位值，不列入共現圖
+GENRE_GRAPH_EXCLUDED = frozenset({"", "unknown"})
+
+def build_genre_graph(artist_ids: np.ndarray, genre_ids: np.ndarray, genre_names: List[str], artist_count: int) -> Optional[Dict]:
+    """由 (藝人, genre) 配對建立稀疏的藝人 × genre 矩陣，計算 genre 共現與分群
+    
+    共現矩陣 A.T @ A 的對角線是各 genre 的藝人數，非對角線是同時擁有兩個 genre 的
+    藝人數。related_genres 列出共現次數最高的 genre 配對（附 Jaccard 相似度）；
+    clusters 以 cosine 距離做 average linkage 階層式分群，只回報至少兩個 genre 的群，
+    依涵蓋的藝人數排序，label 為群內藝人數最多的 genre。同次數一律依 genre 名稱排序，
+    結果與 genre 的編號順序（完整或增量同步）無關。
+    """
+    if sparse is None or not len(genre_ids):
+        return None
+    excluded = np.array([name in GENRE_GRAPH_EXCLUDED for name in genre_names], dtype=bool)
+    keep = ~excluded[genre_ids]
+    matrix = sparse.csr_matrix(
+        (np.ones(int(keep.sum()), dtype=np.float32), (artist_ids[keep], genre_ids[keep])),
+        shape=(artist_count, len(genre_names)),
+    )
+    # 同一位藝人重複列出的 genre 只算一次
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    degrees = np.asarray(matrix.sum(axis=0)).ravel().astype(np.int64)
+    top = top_counts(degrees, GENRE_GRAPH_MAX_GENRES, name_ranks(genre_names))
+    top = top[degrees[top] > 0]
+    sub = matrix.tocsc()[:, top]
+    co = np.asarray((sub.T @ sub).todense(), dtype=np.int64)
+    degree = np.diag(co).copy()
+    names = [genre_names[i] for i in top]
+    graph = {
+        "artists": int(np.count_nonzero(matrix.getnnz(axis=1))),
+        "related_genres": [],
+        "clusters": [],
+    }
+    if len(top) < 2:
+        return graph
+    
+    upper_i, upper_j = np.triu_indices(len(top), k=1)
+    pair_counts = co[upper_i, upper_j]
+    nonzero = np.flatnonzero(pair_counts)
+    # 依共現次數排序，同次數時 genre 排名較前的配對在前
+    order = nonzero[top_counts(pair_counts[nonzero], GENRE_GRAPH_TOP_PAIRS)]
+    for k in order:
+        i, j, count = upper_i[k], upper_j[k], int(pair_counts[k])
+        jaccard = count / (degree[i] + degree[j] - count)
+        graph["related_genres"].append([names[i], names[j], count, round(float(jaccard), 4)])
+    
+    norms = np.sqrt(degree.astype(np.float64))
+    distance = 1.0 - co / np.outer(norms, norms)
+    np.fill_diagonal(distance, 0.0)
+    labels = fcluster(
+        linkage(squareform(np.clip(distance, 0.0, 1.0), checks=False), method="average"),
+        t=GENRE_CLUSTER_DISTANCE,
+        criterion="distance",
+    )
+    clusters = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        if len(members) < 2:
+            continue
+        # members 依 genre 排名（藝人數）排序，第一個就是代表 genre
+        covered = int(np.count_nonzero(sub[:, members].getnnz(axis=1)))
+        clusters.append({"label": names[members[0]], "genres": [names[m] for m in members], "artists": covered})
+    clusters.sort(key=lambda cluster: (-cluster["artists"], cluster["label"]))
+    graph["clusters"] = clusters[:GENRE_CLUSTER_MAX]
+    return graph
+
+class GenreAggregator:
+    """以整數 ID 累計藝人 genre、分類與每月趨勢的聚合器
+    
+    藝人、genre、分類與月份各自對應到依首次出現順序編號的整數 ID，逐筆資料只
+    追加到 array 中；統計時再以 NumPy bincount 一次算出次數，top genres 用
+    argpartition 取候選再排序。編號順序取決於資料到達的順序（完整同步與增量同步
+    不同），因此同次數的 genre 與分類一律依名稱排序，同一份收藏庫的結果才會一致。
+    
+    每位藝人只計一次：genre 次數依藝人的所有 genres 累計（沒有 genre 的藝人記為
+    "unknown"），分類依藝人主要（第一個）genre 決定；每月趨勢以每首歌第一位
+    藝人的分類計算。
+    """
+    
+    def __init__(self):
+        self.artist_index: Dict[str, int] = {}
+        self.genre_index: Dict[str, int] = {}
+        self.genre_names: List[str] = []
+        self.bucket_index: Dict[str, int] = {}
+        self.bucket_names: List[str] = []
+        self.month_index: Dict[str, int] = {}
+        self.month_names: List[str] = []
+        self.artists_resolved = 0
+        self._genre_ids = array("i")  # 每個 (藝人, genre) 配對一筆
+        self._genre_artists = array("i")  # 與 _genre_ids 對應的藝人 ID
+        self._artist_buckets = array("i")  # 依藝人 ID；-1 代表尚未取得 genres
+        self._track_months = array("i")
+        self._track_artists = array("i")
+    
+    @staticmethod
+    def _intern_all(values: List[str], index: Dict[str, int], names: List[str]) -> List[int]:
+        """依首次出現順序為新值編號，回傳每個值的整數 ID"""
+        for value in values:
+            if value not in index:
+                index[value] = len(names)
+                names.append(value)
+        return [index[value] for value in values]
+    
+    def _artist_ids(self, artist_ids: List[str]) -> List[int]:
+        index = self.artist_index
+        for artist_id in artist_ids:
+            if artist_id not in index:
+                index[artist_id] = len(index)
+                self._artist_buckets.append(-1)
+        return [index[artist_id] for artist_id in artist_ids]
+    
+    def has_artist(self, artist_id: str) -> bool:
+        """藝人的 genres 是否已經計入"""
+        index = self.artist_index.get(artist_id)
+        return index is not None and self._artist_buckets[index] >= 0
+    
+    def add_artists(self, artist_genres: Dict[str, List[str]]):
+        """計入新藝人的 genres；已計入過的藝人會被略過"""
+        index, artist_buckets = self.artist_index, self._artist_buckets
+        new_artists = [aid for aid in artist_genres if aid not in index or artist_buckets[index[aid]] < 0]
+        if not new_artists:
+            return
+        genre_lists = [artist_genres[aid] for aid in new_artists]
+        # 沒有 genre 的藝人在 genre 統計中記為 "unknown"
+        flat_genres = [genre for genres in genre_lists for genre in (genres or ("unknown",))]
+        self._genre_ids.extend(self._intern_all(flat_genres, self.genre_index, self.genre_names))
+        artist_indexes = self._artist_ids(new_artists)
+        for artist_index, genres in zip(artist_indexes, genre_lists):
+            self._genre_artists.extend([artist_index] * max(1, len(genres)))
         
-        print(f"DEBUG - Found {len(unknown_artists)} artists without genres")
+        buckets = GENRE_CLASSIFIER.classify_many([genres[0] if genres else "" for genres in genre_lists])
+        bucket_ids = self._intern_all(buckets, self.bucket_index, self.bucket_names)
+        for artist_index, bucket_id in zip(artist_indexes, bucket_ids):
+            self._artist_buckets[artist_index] = bucket_id
+        self.artists_resolved += len(new_artists)
+        unknown_artists = sum(1 for genres in genre_lists if not genres)
         if unknown_artists:
-            print(f"DEBUG - Artists without genres: {unknown_artists[:5]}...")  # 只顯示前5個
-
-        # 統計每個藝術家的類型（避免重複計算）
-        artist_bucket_counts: Dict[str, int] = {}
-        processed_artists = set()  # 避免同一個藝術家被重複計算
+            logger.debug("artists without genres", extra={"count": unknown_artists})
+    
+    @staticmethod
+    def track_fields(tracks: List[SavedTrack]) -> Tuple[List[Optional[str]], List[Optional[str]]]:
+        """取出每首歌的加入月份與第一位藝人（趨勢只需要這兩個欄位）"""
+        months = [track.added_at[:7] if track.added_at else None for track in tracks]
+        first_artists = [track.artist_ids[0] if track.artist_ids else None for track in tracks]
+        return months, first_artists
+    
+    def add_tracks(self, tracks: List[SavedTrack]):
+        """記錄每首歌加入的月份與第一位藝人，供每月趨勢使用"""
+        self.add_track_fields(*self.track_fields(tracks))
+    
+    def add_track_fields(self, months: List[Optional[str]], first_artists: List[Optional[str]]):
+        month_ids = iter(self._intern_all([month for month in months if month], self.month_index, self.month_names))
+        self._track_months.extend(next(month_ids) if month else -1 for month in months)
+        artist_ids = iter(self._artist_ids([artist for artist in first_artists if artist]))
+        self._track_artists.extend(next(artist_ids) if artist else -1 for artist in first_artists)
+    
+    def genre_counts(self) -> np.ndarray:
+        genre_ids = np.frombuffer(self._genre_ids, dtype=np.intc)
+        return np.bincount(genre_ids, minlength=len(self.genre_names))
+    
+    def bucket_counts(self) -> Dict[str, int]:
+        """每個分類的藝人數，依分類名稱排序"""
+        artist_buckets = np.frombuffer(self._artist_buckets, dtype=np.intc)
+        counts = np.bincount(artist_buckets[artist_buckets >= 0], minlength=len(self.bucket_names))
+        return {name: int(counts[i]) for name, i in sorted(self.bucket_index.items()) if counts[i]}
+    
+    def genre_graph(self) -> Optional[Dict]:
+        """genre 共現圖與分群（見 build_genre_graph）；停用或沒有 scipy 時為 None"""
+        if not GENRE_GRAPH_ENABLED:
+            return None
+        return build_genre_graph(
+            np.frombuffer(self._genre_artists, dtype=np.intc),
+            np.frombuffer(self._genre_ids, dtype=np.intc),
+            self.genre_names,
+            len(self.artist_index),
+        )
+    
+    def top_genres(self, n: int = 20) -> List[Tuple[str, int]]:
+        counts = self.genre_counts()
+        return [(self.genre_names[i], int(counts[i])) for i in top_counts(counts, n, name_ranks(self.genre_names))]
+    
+    def monthly_trends(self, final_buckets: Dict[str, int]) -> List[Dict]:
+        """每月新加入歌曲的分類佔比（依月份排序），被合併的小分類計入 Other"""
+        if not self.month_names or not final_buckets:
+            return []
+        columns = list(final_buckets)
+        column_index = {name: i for i, name in enumerate(columns)}
+        other = column_index.get("Other", -1)
+        bucket_columns = np.array(
+            [column_index.get(name, other) for name in self.bucket_names] + [-1],
+            dtype=np.intc,
+        )
+        months = np.frombuffer(self._track_months, dtype=np.intc)
+        track_artists = np.frombuffer(self._track_artists, dtype=np.intc)
+        artist_buckets = np.frombuffer(self._artist_buckets, dtype=np.intc)
+        # 沒有藝人或藝人尚無分類的歌曲對應到 -1 欄（bucket_columns 最後一格）
+        track_buckets = np.where(track_artists >= 0, artist_buckets[np.maximum(track_artists, 0)], -1)
+        track_columns = bucket_columns[track_buckets]
+        valid = (months >= 0) & (track_columns >= 0)
+        width = len(columns)
+        grid = np.bincount(
+            months[valid] * width + track_columns[valid],
+            minlength=len(self.month_names) * width,
+        ).reshape(len(self.month_names), width)
+        totals = grid.sum(axis=1)
+        shares = np.round(grid / np.maximum(totals, 1)[:, None], 4)
         
-        for aid, genres in artist_genres.items():
-            if aid in processed_artists:
+        trends = []
+        for month_id in sorted(range(len(self.month_names)), key=self.month_names.__getitem__):
+            if not totals[month_id]:
                 continue
-            processed_artists.add(aid)
-            
-            if not genres:
-                artist_bucket_counts["Unknown"] = artist_bucket_counts.get("Unknown", 0) + 1
-            else:
-                # 對於每個藝術家，選擇最主要的類型（通常是第一個）
-                primary_genre = genres[0] if genres else "unknown"
-                bucket = map_genre_to_bucket(primary_genre)
-                artist_bucket_counts[bucket] = artist_bucket_counts.get(bucket, 0) + 1
-
-        # 合併相似的分類並限制數量
-        final_buckets = {}
-        min_count_threshold = max(1, len(processed_artists) * 0.02)  # 至少佔 2%
+            trends.append({
+                "month": self.month_names[month_id],
+                "tracks": int(totals[month_id]),
+                "buckets": {columns[c]: float(shares[month_id, c]) for c in np.flatnonzero(grid[month_id])},
+            })
+        return trends
+    
+    def result(self, total_tracks: int, trends: bool = True) -> Dict:
+        """產生 /api/analysis 的回傳內容；trends=False（串流中的 partial 結果）時也略過 genre_graph"""
+        final_buckets = merge_small_buckets(self.bucket_counts())
+        result = {
+            "total_tracks": total_tracks,
+            "buckets": final_buckets,
+            "top_genres": self.top_genres(20),
+        }
+        if trends:
+            result["trends"] = self.monthly_trends(final_buckets)
+            result["genre_graph"] = self.genre_graph()
+        return result
+
+class AnalysisProgress:
+    """追蹤分析進度並推送事件（給串流版 /api/analysis 使用）
+    
+    genre / 分類統計隨著藝人批次完成累加，partial 快照最多每 min_interval 秒
+    產生一次，避免大型收藏庫時每批都重新排序。完整同步結束後這個聚合器直接
+    交給快照（見 full_library_sync），藝人只會被計入一次。
+    """
+    
+    def __init__(self, emit: Callable[[Dict], None], min_interval: float = 0.25):
+        self.emit = emit
+        self.min_interval = min_interval
+        self.pages_fetched = 0
+        self.tracks_fetched = 0
+        self.total_tracks: Optional[int] = None
+        self.aggregator = GenreAggregator()
+        self._last_snapshot = 0.0
+    
+    def page_fetched(self, item_count: int, total: Optional[int]):
+        self.pages_fetched += 1
+        self.tracks_fetched += item_count
+        if total is not None:
+            self.total_tracks = total
+        self.publish("tracks")
+    
+    def artists_resolved(self, artist_genres: Dict[str, List[str]]):
+        if not artist_genres:
+            return
+        self.aggregator.add_artists(artist_genres)
+        self.publish("artists")
+    
+    def publish(self, phase: str):
+        event = {
+            "type": "progress",
+            "phase": phase,
+            "pages_fetched": self.pages_fetched,
+            "tracks_fetched": self.tracks_fetched,
+            "total_tracks": self.total_tracks,
+            "artists_resolved": self.aggregator.artists_resolved,
+        }
+        now = time.monotonic()
+        if self.aggregator.artists_resolved and now - self._last_snapshot >= self.min_interval:
+            self._last_snapshot = now
+            partial = self.aggregator.result(self.tracks_fetched, trends=False)
+            event["buckets"] = partial["buckets"]
+            event["top_genres"] = partial["top_genres"]
+        self.emit(event)
+
+# 聚合階段的執行方式：inline（直接在 event loop 上）、thread 或 process（可用多核心）
+AGGREGATION_EXECUTOR = os.getenv("AGGREGATION_EXECUTOR", "thread").lower()
+AGGREGATION_WORKERS = int(os.getenv("AGGREGATION_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 新歌曲少於這個數量時直接在 event loop 上聚合，省下排程與序列化成本
+AGGREGATION_OFFLOAD_MIN_TRACKS = int(os.getenv("AGGREGATION_OFFLOAD_MIN_TRACKS", "2000"))
+AGGREGATION_POOL: Optional[Executor] = None
+
+def get_aggregation_pool() -> Optional[Executor]:
+    """取得聚合用的 worker pool（第一次使用時建立）；inline 模式回傳 None"""
+    global AGGREGATION_POOL
+    if AGGREGATION_POOL is None:
+        if AGGREGATION_EXECUTOR == "process":
+            # 用 spawn 而非 fork：服務程序已有 event loop 與其他 thread，fork 可能繼承被佔用的鎖
+            AGGREGATION_POOL = ProcessPoolExecutor(
+                max_workers=AGGREGATION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        elif AGGREGATION_EXECUTOR == "thread":
+            AGGREGATION_POOL = ThreadPoolExecutor(max_workers=AGGREGATION_WORKERS, thread_name_prefix="aggregation")
+    return AGGREGATION_POOL
+
+def shutdown_aggregation_pool():
+    global AGGREGATION_POOL
+    if AGGREGATION_POOL is not None:
+        AGGREGATION_POOL.shutdown(wait=False, cancel_futures=True)
+        AGGREGATION_POOL = None
+
+def run_aggregation(
+    aggregator: GenreAggregator,
+    artist_genres: Dict[str, List[str]],
+    months: List[Optional[str]],
+    first_artists: List[Optional[str]],
+    total_tracks: int,
+) -> Tuple[GenreAggregator, Dict]:
+    """聚合階段本體：可在 worker thread 或 process 中執行
+    
+    輸入只有藝人 genres 與每首歌的月份 / 第一位藝人字串列表，送往 process
+    時序列化成本低；process 模式下回傳的是更新後的 aggregator 副本。
+    """
+    aggregator.add_artists(artist_genres)
+    aggregator.add_track_fields(months, first_artists)
+    return aggregator, aggregator.result(total_tracks)
+
+class LibrarySnapshot:
+    """使用者收藏庫的快照：歌曲（新到舊）與已累計的 genre / 分類統計
+    
+    tracks 為 SavedTrack 投影，足以判斷哪些歌曲是新加入的；統計由
+    GenreAggregator 以整數 ID 增量累計，最近一次的分析結果一併保留。
+    audio_features 是每首歌一列的 float32 音訊特徵（順序不需與 tracks 一致），
+    None 代表尚未取得或上次抓取失敗。
+    """
+    
+    def __init__(self):
+        self.tracks: List[SavedTrack] = []
+        self.track_keys = set()
+        self.aggregator = GenreAggregator()
+        self.audio_features: Optional[np.ndarray] = None
+        self.synced_at = 0.0
+        self.used_at = time.time()
+        self._result: Optional[Dict] = None
+    
+    async def apply(self, new_tracks: List[SavedTrack], new_artist_genres: Dict[str, List[str]]):
+        """把新加入的歌曲（新到舊）與其新藝人的 genres 併入快照，只累加差異部分
         
-        for bucket, count in artist_bucket_counts.items():
-            if count >= min_count_threshold:
-                final_buckets[bucket] = count
+        新歌曲夠多時聚合交給 worker pool，event loop 不會被大型收藏庫卡住。
+        """
+        self.tracks[:0] = new_tracks
+        self.track_keys.update(t.key for t in new_tracks)
+        months, first_artists = GenreAggregator.track_fields(new_tracks)
+        args = (self.aggregator, new_artist_genres, months, first_artists, len(self.tracks))
+        pool = get_aggregation_pool() if len(new_tracks) >= AGGREGATION_OFFLOAD_MIN_TRACKS else None
+        if pool is None:
+            self.aggregator, self._result = run_aggregation(*args)
+        else:
+            loop = asyncio.get_running_loop()
+            try:
+                self.aggregator, self._result = await loop.run_in_executor(pool, run_aggregation, *args)
+            except BrokenExecutor:
+                # worker 異常結束時 pool 無法再使用：重建 pool，這次改在 event loop 上完成
+                logger.warning("aggregation pool broken, falling back to inline", exc_info=True)
+                shutdown_aggregation_pool()
+                self.aggregator, self._result = run_aggregation(*args)
+        self.synced_at = time.time()
+    
+    def set_audio_features(self, features: Optional[np.ndarray], append: bool = False):
+        """更新音訊特徵；append=True 時把新歌曲的特徵併入既有陣列"""
+        if append and features is not None and self.audio_features is not None:
+            features = np.concatenate([features, self.audio_features])
+        self.audio_features = features
+        if self._result is not None:
+            # 先前的結果可能仍被快取或正在回傳，建立新的 dict 而不是就地修改
+            self._result = {key: value for key, value in self._result.items() if key != "audio_features"}
+    
+    def result(self) -> Dict:
+        if not self.tracks:
+            return {"total_tracks": 0, "buckets": {}, "top_genres": [], "trends": [], "genre_graph": None, "audio_features": None}
+        if self._result is None:
+            self._result = self.aggregator.result(len(self.tracks))
+        if "audio_features" not in self._result:
+            self._result["audio_features"] = summarize_audio_features(self.audio_features)
+        return self._result
+
+# 增量同步：重複分析時只抓取上次之後新加入的歌曲
+INCREMENTAL_SYNC = env_flag("INCREMENTAL_SYNC", True)
+# 記憶體中最多保留幾位使用者的收藏快照（LRU）；一萬首歌的快照約 7 MB
+LIBRARY_SNAPSHOT_MAX_USERS = int(os.getenv("LIBRARY_SNAPSHOT_MAX_USERS", "20"))
+# 快照最後一次使用後保留多久（秒），過期後下次分析改走完整同步
+LIBRARY_SNAPSHOT_TTL = float(os.getenv("LIBRARY_SNAPSHOT_TTL", "21600"))
+LIBRARY_SNAPSHOTS: "OrderedDict[str, LibrarySnapshot]" = OrderedDict()
+# 未完成的完整同步（例如超過 ANALYSIS_DEADLINE）保留已抓到的分頁多久（秒）
+PARTIAL_SYNC_TTL = float(os.getenv("PARTIAL_SYNC_TTL", "900"))
+
+class PartialLibrary:
+    """尚未完成的完整同步已抓到的分頁（offset -> SavedTrack），讓下次同步從中斷處接續
+    
+    收藏庫在兩次同步之間變動時 offset 會位移，因此只有第一頁內容與歌曲總數都
+    沒變時才沿用，否則整份丟棄重新抓取。
+    """
+    
+    def __init__(self):
+        self.total: Optional[int] = None
+        self.pages: Dict[int, List[SavedTrack]] = {}
+        self.updated_at = time.time()
+    
+    def resumable_offsets(self, first_items: List[Dict], total: Optional[int]) -> set:
+        """比對剛抓到的第一頁，回傳可沿用（不需再抓）的 offset"""
+        self.updated_at = time.time()
+        first = self.pages.get(0)
+        if first is None or total != self.total or [t.key for t in first] != [t.key for t in project_saved_tracks(first_items)]:
+            self.pages.clear()
+            self.total = total
+            return set()
+        logger.info("resuming library sync", extra={"pages": len(self.pages), "total": total})
+        return set(self.pages) - {0}
+
+PARTIAL_LIBRARIES: "OrderedDict[str, PartialLibrary]" = OrderedDict()
+
+def get_partial_library(user_id: str) -> PartialLibrary:
+    """取得使用者未完成的同步進度；過期或不存在時建立新的"""
+    partial = PARTIAL_LIBRARIES.get(user_id)
+    if partial is None or time.time() - partial.updated_at > PARTIAL_SYNC_TTL:
+        partial = PARTIAL_LIBRARIES[user_id] = PartialLibrary()
+    PARTIAL_LIBRARIES.move_to_end(user_id)
+    while len(PARTIAL_LIBRARIES) > LIBRARY_SNAPSHOT_MAX_USERS:
+        PARTIAL_LIBRARIES.popitem(last=False)
+    return partial
+
+ME_URL = "https://api.spotify.com/v1/me"
+
+async def get_spotify_user_id(session: Dict) -> Optional[str]:
+    """取得 session 對應的 Spotify user ID（只在第一次呼叫 /v1/me）"""
+    if not session.get("user_id"):
+        headers = {"Authorization": f"Bearer {session['access_token']}"}
+        r = await spotify_request("GET", ME_URL, headers=headers, timeout=10.0, priority=PRIORITY_INTERACTIVE)
+        if r.status_code == 200:
+            session["user_id"] = r.json().get("id")
+            save_session(session)
+    return session.get("user_id")
+
+def get_snapshot(user_id: str) -> Optional[LibrarySnapshot]:
+    """取得使用者的收藏快照；超過 LIBRARY_SNAPSHOT_TTL 未使用的視為不存在"""
+    snapshot = LIBRARY_SNAPSHOTS.get(user_id)
+    if snapshot is None:
+        return None
+    now = time.time()
+    if now - snapshot.used_at > LIBRARY_SNAPSHOT_TTL:
+        del LIBRARY_SNAPSHOTS[user_id]
+        return None
+    snapshot.used_at = now
+    LIBRARY_SNAPSHOTS.move_to_end(user_id)
+    return snapshot
+
+def sweep_library_snapshots() -> int:
+    """移除過期的收藏快照與未完成的同步進度，回傳移除的數量"""
+    now = time.time()
+    expired = [uid for uid, snapshot in LIBRARY_SNAPSHOTS.items() if now - snapshot.used_at > LIBRARY_SNAPSHOT_TTL]
+    for user_id in expired:
+        del LIBRARY_SNAPSHOTS[user_id]
+    stale_partials = [uid for uid, partial in PARTIAL_LIBRARIES.items() if now - partial.updated_at > PARTIAL_SYNC_TTL]
+    for user_id in stale_partials:
+        del PARTIAL_LIBRARIES[user_id]
+    return len(expired) + len(stale_partials)
+
+def store_snapshot(user_id: str, snapshot: LibrarySnapshot):
+    snapshot.used_at = time.time()
+    LIBRARY_SNAPSHOTS[user_id] = snapshot
+    LIBRARY_SNAPSHOTS.move_to_end(user_id)
+    while len(LIBRARY_SNAPSHOTS) > LIBRARY_SNAPSHOT_MAX_USERS:
+        LIBRARY_SNAPSHOTS.popitem(last=False)
+
+async def update_audio_features(access_token: str, snapshot: LibrarySnapshot, new_tracks: List[SavedTrack]):
+    """為新歌曲補上音訊特徵；快照還沒有特徵時查詢整個收藏庫（多數會命中共用快取）
+    
+    音訊特徵是附加資訊，抓取失敗只記錄警告，分析結果的 audio_features 為 null，
+    下次同步時再重試；403（app 沒有這個端點的權限）則停止之後的所有查詢。
+    """
+    global AUDIO_FEATURES_FORBIDDEN
+    if not AUDIO_FEATURES_ENABLED or AUDIO_FEATURES_FORBIDDEN:
+        return
+    append = snapshot.audio_features is not None
+    tracks = new_tracks if append else snapshot.tracks
+    if not tracks:
+        return
+    try:
+        with phase_timer("audio_features"), deadline(AUDIO_FEATURES_DEADLINE):
+            features = await fetch_audio_features(access_token, [track.key for track in tracks])
+    except HTTPException as e:
+        if e.status_code == 403:
+            AUDIO_FEATURES_FORBIDDEN = True
+            logger.warning("audio features endpoint forbidden for this app, disabling audio features")
+        else:
+            logger.warning("audio features unavailable", extra={"status": e.status_code})
+        snapshot.set_audio_features(None)
+        return
+    except httpx.HTTPError as e:
+        # 重試後仍連不上：音訊特徵只是附加資訊，不讓整個分析失敗
+        logger.warning("audio features unavailable", extra={"error": str(e)})
+        snapshot.set_audio_features(None)
+        return
+    snapshot.set_audio_features(features, append=append)
+
+async def full_library_sync(
+    access_token: str,
+    progress: Optional[AnalysisProgress] = None,
+    user_id: Optional[str] = None,
+) -> LibrarySnapshot:
+    """完整抓取收藏庫並建立新的快照
+    
+    有 user_id 時會沿用並更新該使用者未完成的同步進度，抓取成功後才清除。
+    串流時 progress 已逐批計入所有藝人的 genres，快照直接沿用它的聚合器，
+    聚合階段只需補上歌曲的月份與藝人，不會把藝人再算一遍。
+    """
+    resume = get_partial_library(user_id) if user_id else None
+    tracks, artist_genres = await fetch_library_with_genres(access_token, progress, resume)
+    if user_id:
+        PARTIAL_LIBRARIES.pop(user_id, None)
+    logger.debug("full library sync", extra={"tracks": len(tracks), "artists": len(artist_genres)})
+    snapshot = LibrarySnapshot()
+    if progress is not None:
+        # 已計入的藝人在 apply 時會被略過；同次數一律依名稱排序，藝人計入的順序不影響結果
+        snapshot.aggregator = progress.aggregator
+    with phase_timer("aggregation"):
+        await snapshot.apply(tracks, artist_genres)
+    await update_audio_features(access_token, snapshot, tracks)
+    return snapshot
+
+async def incremental_library_sync(access_token: str, snapshot: LibrarySnapshot, progress: Optional[AnalysisProgress] = None) -> Optional[LibrarySnapshot]:
+    """從最新的收藏往回翻頁，遇到已知歌曲就停止，只處理新加入的部分
+    
+    若一直沒有遇到已知歌曲，或歌曲總數對不上（代表有歌曲被移除），回傳 None
+    讓呼叫端改做完整同步。
+    """
+    new_items: List[SavedTrack] = []
+    offset = 0
+    total = None
+    reached_known = False
+    with phase_timer("track_fetch"):
+        while not reached_known:
+            j = await fetch_saved_tracks_page(access_token, offset)
+            total = j.get("total")
+            items = j.get("items", [])
+            if progress is not None:
+                progress.page_fetched(len(items), total)
+            for track in project_saved_tracks(items):
+                if track.key in snapshot.track_keys:
+                    reached_known = True
+                    break
+                new_items.append(track)
+            if not items or j.get("next") is None:
+                break
+            offset += SAVED_TRACKS_PAGE_SIZE
+    
+    if not reached_known or total != len(snapshot.tracks) + len(new_items):
+        logger.info("library snapshot out of date, falling back to full sync", extra={"total": total, "known": len(snapshot.tracks)})
+        return None
+    
+    if new_items:
+        new_artists = [aid for aid in collect_artist_ids(new_items) if not snapshot.aggregator.has_artist(aid)]
+        with phase_timer("artist_fetch"):
+            new_artist_genres = await fetch_artists_genres(access_token, new_artists)
+        with phase_timer("aggregation"):
+            await snapshot.apply(new_items, new_artist_genres)
+    else:
+        snapshot.synced_at = time.time()
+    await update_audio_features(access_token, snapshot, new_items)
+    logger.debug("incremental library sync", extra={"new_tracks": len(new_items)})
+    return snapshot
+
+# 分析的 admission control：全域與每位使用者同時進行的分析上限，以及等待佇列的長度與逾時秒數
+ANALYSIS_MAX_CONCURRENT = int(os.getenv("ANALYSIS_MAX_CONCURRENT", "4"))
+ANALYSIS_MAX_PER_USER = int(os.getenv("ANALYSIS_MAX_PER_USER", "1"))
+ANALYSIS_QUEUE_SIZE = int(os.getenv("ANALYSIS_QUEUE_SIZE", "32"))
+ANALYSIS_QUEUE_TIMEOUT = float(os.getenv("ANALYSIS_QUEUE_TIMEOUT", "30"))
+# 被拒絕時建議用戶端等待的秒數（Retry-After）
+ANALYSIS_RETRY_AFTER = int(os.getenv("ANALYSIS_RETRY_AFTER", "10"))
+# 一次分析（取得名額之後）所有上游呼叫的總時間預算（秒，0 = 不限制）
+ANALYSIS_DEADLINE = float(os.getenv("ANALYSIS_DEADLINE", "300"))
+
+class AdmissionController:
+    """限制同時進行的昂貴計算：全域與每位使用者的並行上限，加上有長度上限、會逾時的 FIFO 佇列
+    
+    佇列已滿或等待逾時時拋出 503 並附上 Retry-After，讓多出來的負載被快速拒絕，
+    而不是拖慢所有人。輪到的等待者若該使用者已達上限會被略過，不會擋住後面其他使用者。
+    """
+    
+    def __init__(self, max_concurrent: int, per_user: int, max_queue: int, queue_timeout: float, retry_after: int):
+        self.max_concurrent = max(1, max_concurrent)
+        self.per_user = max(1, per_user)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self._active_by_user: Dict[str, int] = {}
+        self._waiters: "OrderedDict[asyncio.Future, str]" = OrderedDict()
+    
+    def _can_admit(self, user: str) -> bool:
+        return self.active < self.max_concurrent and self._active_by_user.get(user, 0) < self.per_user
+    
+    def _take(self, user: str):
+        self.active += 1
+        self._active_by_user[user] = self._active_by_user.get(user, 0) + 1
+    
+    def busy_error(self) -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail="server busy, please retry later",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+    
+    def check(self, user: str):
+        """會被立即拒絕時拋出 503（不佔用名額），讓串流端點在送出 200 前先回報"""
+        if not self._can_admit(user) and len(self._waiters) >= self.max_queue:
+            ANALYSIS_REJECTED.labels("queue_full").inc()
+            raise self.busy_error()
+    
+    async def acquire(self, user: str):
+        if self._can_admit(user):
+            self._take(user)
+            return
+        if len(self._waiters) >= self.max_queue:
+            ANALYSIS_REJECTED.labels("queue_full").inc()
+            raise self.busy_error()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[future] = user
+        ANALYSIS_QUEUE_DEPTH.inc()
+        # 不用 wait_for：Python 3.11 的 wait_for 在 future 已有結果時會吞掉取消，
+        # 被取消的呼叫端會繼續佔著名額執行
+        try:
+            await asyncio.wait((future,), timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if future.done():
+                # 已分配到名額但呼叫端被取消，交給下一位
+                self.release(user)
             else:
-                # 將小分類合併到 "Other"
-                final_buckets["Other"] = final_buckets.get("Other", 0) + count
+                future.cancel()
+            raise
+        finally:
+            if self._waiters.pop(future, None) is not None:
+                ANALYSIS_QUEUE_DEPTH.dec()
+        if not future.done():
+            future.cancel()
+            ANALYSIS_REJECTED.labels("timeout").inc()
+            raise self.busy_error()
+    
+    def release(self, user: str):
+        self.active -= 1
+        remaining = self._active_by_user.get(user, 1) - 1
+        if remaining > 0:
+            self._active_by_user[user] = remaining
+        else:
+            self._active_by_user.pop(user, None)
+        self._dispatch()
+    
+    def _dispatch(self):
+        for future, user in list(self._waiters.items()):
+            if self.active >= self.max_concurrent:
+                break
+            if future.done() or not self._can_admit(user):
+                continue
+            del self._waiters[future]
+            ANALYSIS_QUEUE_DEPTH.dec()
+            self._take(user)
+            future.set_result(None)
+
+ANALYSIS_ADMISSION = AdmissionController(
+    ANALYSIS_MAX_CONCURRENT, ANALYSIS_MAX_PER_USER, ANALYSIS_QUEUE_SIZE, ANALYSIS_QUEUE_TIMEOUT, ANALYSIS_RETRY_AFTER
+)
+
+def admission_key(session: Dict) -> str:
+    """每位使用者上限的計算單位：已知 Spotify user ID 時以使用者計，否則以 session 計"""
+    return session.get("user_id") or session["id"]
+
+async def compute_analysis(session: Dict, full_refresh: bool = False, progress: Optional[AnalysisProgress] = None) -> Dict:
+    """執行收藏庫分析；有快照時以增量同步只處理新加入的歌曲
+    
+    計算前先經過 admission control 取得名額，佇列已滿或等待逾時時拋出 503。
+    上游呼叫共用 ANALYSIS_DEADLINE 的時間預算；熔斷器開啟或時間用完時，若有
+    該使用者先前的快照，就回傳它並標記 stale。
+    """
+    user_key = admission_key(session)
+    await ANALYSIS_ADMISSION.acquire(user_key)
+    timings: Dict[str, float] = {}
+    timings_token = _PHASE_TIMINGS.set(timings)
+    ANALYSES_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    user_id = None
+    try:
+        with deadline(ANALYSIS_DEADLINE):
+            await TOKEN_MANAGER.ensure_fresh(session)
+            access_token = session["access_token"]
+            
+            user_id = await get_spotify_user_id(session) if INCREMENTAL_SYNC else None
+            snapshot = None
+            mode = "full"
+            if user_id and not full_refresh:
+                previous = get_snapshot(user_id)
+                if previous is not None and previous.tracks:
+                    snapshot = await incremental_library_sync(access_token, previous, progress)
+                    mode = "incremental" if snapshot is not None else "full"
+            if snapshot is None:
+                snapshot = await full_library_sync(access_token, progress, user_id)
+        if user_id:
+            store_snapshot(user_id, snapshot)
         
-        # 如果分類太多（超過10個），合併最小的幾個
-        if len(final_buckets) > 10:
-            sorted_buckets = sorted(final_buckets.items(), key=lambda x: x[1], reverse=True)
-            main_buckets = dict(sorted_buckets[:9])  # 保留前9個
-            other_count = sum(count for _, count in sorted_buckets[9:])  # 其餘合併
-            if other_count > 0:
-                main_buckets["Other"] = other_count
-            final_buckets = main_buckets
-
-        # top N genres
-        top_genres = sorted(genre_counts.items(), key=lambda x: x[1], reverse=True)[:20]
+        with phase_timer("aggregation"):
+            result = snapshot.result()
+    except (UpstreamUnavailable, DeadlineExceeded) as e:
+        user_id = user_id or session.get("user_id")
+        previous = get_snapshot(user_id) if user_id else None
+        if previous is None or not previous.tracks:
+            raise
+        logger.warning("serving stale analysis", extra={"status": e.status_code, "detail": e.detail})
+        return {**previous.result(), "stale": True}
+    finally:
+        ANALYSIS_ADMISSION.release(user_key)
+        ANALYSES_IN_FLIGHT.dec()
+        _PHASE_TIMINGS.reset(timings_token)
+    
+    for phase, seconds in timings.items():
+        ANALYSIS_PHASE_LATENCY.labels(phase, mode).observe(seconds)
+    logger.info("analysis complete", extra={
+        "mode": mode,
+        "total_tracks": result["total_tracks"],
+        "buckets": len(result["buckets"]),
+        "duration": round(time.perf_counter() - started, 3),
+        "phases": {phase: round(seconds, 3) for phase, seconds in timings.items()},
+    })
+    return result
 
-        result = {
-            "total_tracks": len(tracks),
-            "buckets": final_buckets,
-            "top_genres": top_genres
+class SingleFlight:
+    """同一個 key 同時只跑一次計算，並發的呼叫者共同等待同一個結果
+    
+    完成的結果會保留 ttl 秒，期間重複請求直接回傳而不再打上游；cacheable 回傳
+    False 的結果（例如熔斷時的舊資料）只交給這一輪的呼叫者，不會保留。計算本身以
+    獨立 task 執行，個別呼叫者取消（例如斷線）不會中斷其他人正在等待的計算。
+    """
+    
+    def __init__(self, ttl: float, max_entries: int = 10000, cacheable: Optional[Callable[[object], bool]] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cacheable = cacheable
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._results: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+    
+    def get_cached(self, key: str):
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._results[key]
+            return None
+        return entry[1]
+    
+    def store(self, key: str, result):
+        if self.ttl <= 0 or (self.cacheable is not None and not self.cacheable(result)):
+            return
+        self._results[key] = (time.time() + self.ttl, result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+    
+    def invalidate(self, key: str):
+        self._results.pop(key, None)
+    
+    def sweep(self) -> int:
+        """移除已過期的結果，回傳移除的數量（計算中的 key 不受影響）"""
+        now = time.time()
+        expired = [key for key, (expires_at, _) in self._results.items() if expires_at <= now]
+        for key in expired:
+            del self._results[key]
+        return len(expired)
+    
+    def in_flight(self, key: str) -> bool:
+        return key in self._inflight
+    
+    def refresh(self, key: str, factory: Callable[[], Awaitable]) -> asyncio.Task:
+        """在背景重新計算 key；完成前 run() 仍回傳既有的結果，已在計算中則沿用該 task"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._execute(key, factory))
+            self._inflight[key] = task
+        return task
+    
+    async def _execute(self, key: str, factory: Callable[[], Awaitable]):
+        try:
+            result = await factory()
+            self.store(key, result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+    
+    async def run(self, key: str, factory: Callable[[], Awaitable]):
+        cached = self.get_cached(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(self._execute(key, factory))
+            self._inflight[key] = task
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses + self.joined
+        return {
+            "size": len(self._results),
+            "in_flight": len(self._inflight),
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "joined": self.joined,
+            "hit_ratio": (self.hits + self.joined) / lookups if lookups else 0.0,
         }
-        
-        print(f"DEBUG - Analysis - Returning result with {len(final_buckets)} genre buckets")
+
+# 分析結果的短期快取秒數（0 = 只合併並發請求，不保留結果）
+ANALYSIS_RESULT_TTL = float(os.getenv("ANALYSIS_RESULT_TTL", "300"))
+# 上游故障時回傳的 stale 結果不快取，恢復後的下一次請求就重新計算
+ANALYSIS_FLIGHTS = SingleFlight(ttl=ANALYSIS_RESULT_TTL, cacheable=lambda result: not result.get("stale"))
+
+def analysis_key(session_id: str, session: Dict) -> str:
+    """以 Spotify user ID 合併同一使用者的分析；尚未知道 user ID 時用 session"""
+    if session.get("user_id"):
+        return f"user:{session['user_id']}"
+    return f"session:{session_id}"
+
+def analysis_job(
+    session_id: str,
+    session: Dict,
+    key: str,
+    full_refresh: bool = False,
+    progress: Optional[AnalysisProgress] = None,
+) -> Callable[[], Awaitable[Dict]]:
+    async def compute_and_store() -> Dict:
+        result = await compute_analysis(session, full_refresh=full_refresh, progress=progress)
+        # 第一次分析時才得知 user ID，同時以 user key 保存，之後的請求可直接命中
+        user_key = analysis_key(session_id, session)
+        if user_key != key:
+            ANALYSIS_FLIGHTS.store(user_key, result)
         return result
+    return compute_and_store
+
+async def get_analysis(
+    session_id: str,
+    session: Dict,
+    full_refresh: bool = False,
+    progress: Optional[AnalysisProgress] = None,
+) -> Dict:
+    """取得分析結果；同一使用者並發的請求合併成一次計算
+    
+    progress 只在這次呼叫真的開始計算時收到進度，加入既有計算時只會拿到最終結果。
+    """
+    key = analysis_key(session_id, session)
+    if full_refresh:
+        ANALYSIS_FLIGHTS.invalidate(key)
+    else:
+        # 登入後的預熱在得知 user ID 前就以 session key 開始計算，期間的請求一併加入
+        session_key = analysis_key(session_id, {})
+        if key != session_key and ANALYSIS_FLIGHTS.in_flight(session_key) and ANALYSIS_FLIGHTS.get_cached(key) is None:
+            key = session_key
+    return await ANALYSIS_FLIGHTS.run(key, analysis_job(session_id, session, key, full_refresh, progress))
+
+# 登入後在背景預先計算分析
+ANALYSIS_PREWARM = env_flag("ANALYSIS_PREWARM", True)
+# 定期在背景刷新最近活躍 session 的分析（秒，0 = 停用）；刷新走增量同步，成本很低
+ANALYSIS_REFRESH_INTERVAL = float(os.getenv("ANALYSIS_REFRESH_INTERVAL", "0"))
+# 最後一次請求在這段時間內的 session 才算活躍
+ANALYSIS_REFRESH_ACTIVE_WINDOW = float(os.getenv("ANALYSIS_REFRESH_ACTIVE_WINDOW", "1800"))
+SESSION_LAST_SEEN: Dict[str, float] = {}
+# 保留背景 task 的參照，避免執行中被回收
+BACKGROUND_TASKS = set()
+
+def spawn_background(coro: Awaitable) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+async def refresh_analysis(session_id: str, session: Dict):
+    """在背景重新計算分析；完成前讀取者仍拿到上一次的結果"""
+    key = analysis_key(session_id, session)
+    await ANALYSIS_FLIGHTS.refresh(key, analysis_job(session_id, session, key))
+
+async def prewarm_analysis(session_id: str, session: Dict):
+    try:
+        await refresh_analysis(session_id, session)
+        logger.debug("analysis prewarmed", extra={"session": session_id[:8]})
+    except Exception as e:
+        logger.warning("analysis prewarm failed", extra={"error_type": type(e).__name__})
+
+async def refresh_active_analyses():
+    """定期刷新活躍 session 的分析，一次一個；上游有請求在排隊時讓出，留待下一輪"""
+    while True:
+        await asyncio.sleep(ANALYSIS_REFRESH_INTERVAL)
+        refreshed = 0
+        try:
+            now = time.monotonic()
+            for session_id, last_seen in list(SESSION_LAST_SEEN.items()):
+                if now - last_seen > ANALYSIS_REFRESH_ACTIVE_WINDOW:
+                    SESSION_LAST_SEEN.pop(session_id, None)
+                    continue
+                session = SESSION_STORE.get(session_id)
+                if session is None:
+                    SESSION_LAST_SEEN.pop(session_id, None)
+                    continue
+                if get_scheduler().stats()["waiting"]:
+                    break
+                try:
+                    await refresh_analysis(session_id, session)
+                    refreshed += 1
+                except Exception as e:
+                    logger.warning("analysis refresh failed", extra={"error_type": type(e).__name__})
+            if refreshed:
+                logger.debug("refreshed active analyses", extra={"count": refreshed})
+        except Exception:
+            logger.exception("analysis refresher failed")
+
+@app.get("/api/analysis")
+async def analysis(request: Request, full: bool = False):
+    try:
+        session_id, session = get_session(request)
+        
+        if session is None:
+            logger.debug("analysis without valid session")
+            return JSONResponse({"error": "not_logged_in"}, status_code=401)
+        
+        # 直接回傳 Response，略過 FastAPI 對 dict 逐值呼叫 jsonable_encoder 的步驟
+        return DefaultJSONResponse(await get_analysis(session_id, session, full_refresh=full))
         
+    except HTTPException:
+        # 上游錯誤（如 401 / 503 rate limit）保留原本的狀態碼與 Retry-After
+        raise
     except Exception as e:
-        print(f"ERROR - Analysis failed: {str(e)}")
-        print(f"ERROR - Exception type: {type(e).__name__}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("analysis failed", extra={"error_type": type(e).__name__})
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
-@app.get("/api/status")
-async def login_status(request: Request):
-    """檢查用戶登入狀態的輕量級端點"""
-    session_id = get_session_id(request)
+def encode_stream_event(event: Dict, fmt: str) -> str:
+    data = encode_json(event).decode("utf-8")
+    if fmt == "sse":
+        return f"event: {event['type']}\ndata: {data}\n\n"
+    return data + "\n"
+
+@app.get("/api/analysis/stream")
+async def analysis_stream(
+    request: Request,
+    format: str = Query("ndjson", regex="^(ndjson|sse)$"),
+    full: bool = False,
+):
+    """串流版分析：邊抓取邊推送進度與目前的 buckets / top_genres 快照
     
-    print(f"DEBUG - Status check - Session ID: {session_id}")
-    print(f"DEBUG - Status check - All cookies: {dict(request.cookies)}")
-    print(f"DEBUG - Status check - Session header: {request.headers.get('X-Session-ID')}")
-    print(f"DEBUG - Status check - Active sessions: {list(SESSIONS.keys())}")
+    最後一個 result 事件的 data 與 /api/analysis 的回傳內容相同。
+    """
+    session_id, session = get_session(request)
+    if session is None:
+        return JSONResponse({"error": "not_logged_in"}, status_code=401)
     
-    if not session_id or session_id not in SESSIONS:
-        return JSONResponse({"logged_in": False}, status_code=200)
+    queue: asyncio.Queue = asyncio.Queue()
+    progress = AnalysisProgress(queue.put_nowait)
+    key = analysis_key(session_id, session)
+    cached = None if full else ANALYSIS_FLIGHTS.get_cached(key)
+    if cached is None and (full or not (ANALYSIS_FLIGHTS.in_flight(key) or ANALYSIS_FLIGHTS.in_flight(analysis_key(session_id, {})))):
+        # 需要重新計算而佇列已滿時，在開始串流前就回 503
+        ANALYSIS_ADMISSION.check(admission_key(session))
     
-    session = SESSIONS[session_id]
-    # 檢查 token 是否還有效
-    if time.time() > session["expires_at"]:
-        # Token 已過期，嘗試刷新
+    async def run():
         try:
-            await refresh_token_if_needed(session)
-        except:
-            # 刷新失敗，清除無效 session
-            del SESSIONS[session_id]
-            return JSONResponse({"logged_in": False}, status_code=200)
+            if cached is not None:
+                result = cached
+            else:
+                # 經過 single-flight：背景預熱或其他請求正在計算時等待同一個結果，
+                # 由這裡開始的計算也能讓並發的 /api/analysis 加入，不重複抓取
+                result = await get_analysis(session_id, session, full_refresh=full, progress=progress)
+            queue.put_nowait({"type": "result", "data": result})
+        except HTTPException as e:
+            queue.put_nowait({"type": "error", "status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            logger.exception("streaming analysis failed")
+            queue.put_nowait({"type": "error", "status_code": 500, "detail": f"Analysis failed: {str(e)}"})
+        finally:
+            queue.put_nowait(None)
     
-    # 獲取用戶基本資料
-    try:
-        access_token = session["access_token"]
-        user_url = "https://api.spotify.com/v1/me"
-        headers = {"Authorization": f"Bearer {access_token}"}
-        
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            user_response = await client.get(user_url, headers=headers)
-            if user_response.status_code == 200:
-                user_data = user_response.json()
-                return JSONResponse({
-                    "logged_in": True, 
-                    "user": {
-                        "display_name": user_data.get("display_name"),
-                        "country": user_data.get("country"),
-                        "followers": user_data.get("followers"),
-                        "images": user_data.get("images", [])
-                    }
-                }, status_code=200)
-    except Exception as e:
-        print(f"DEBUG - Error fetching user data: {e}")
+    async def events():
+        task = asyncio.create_task(run())
+        try:
+            yield encode_stream_event({"type": "progress", "phase": "started"}, format)
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                yield encode_stream_event(event, format)
+        finally:
+            # 用戶端中斷連線時停止等待；共用的計算仍會完成並保存結果
+            if not task.done():
+                task.cancel()
     
-    return JSONResponse({"logged_in": True}, status_code=200)
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(
+        events(),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-@app.get("/logout")
-async def logout(response: Response):
-    response = RedirectResponse("/")
-    response.delete_cookie("session_id")
-    return response
+class CachedResponse:
+    """已序列化的 JSON 回應與其 ETag"""
+    __slots__ = ("body", "etag", "expires_at")
+    
+    def __init__(self, body: bytes, etag: str, expires_at: float):
+        self.body = body
+        self.etag = etag
+        self.expires_at = expires_at
 
-@app.get("/api/top-tracks")
-async def top_tracks(request: Request, time_range: str = Query("medium_term", regex="^(short_term|medium_term|long_term)$")):
-    session_id = get_session_id(request)
-    if not session_id or session_id not in SESSIONS:
-        return JSONResponse({"error": "not_logged_in"}, status_code=401)
-    session = SESSIONS[session_id]
-    await refresh_token_if_needed(session)
-    access_token = session["access_token"]
+class ResponseCache:
+    """每個 session 的端點回應快取，key 為 (session_id, endpoint, 參數)"""
+    
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, CachedResponse]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: Tuple) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= time.time():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+    
+    def put(self, key: Tuple, payload: Dict, ttl: float) -> CachedResponse:
+        body = encode_json(payload)
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        entry = CachedResponse(body, etag, time.time() + ttl)
+        if ttl > 0:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+    
+    def invalidate_session(self, session_id: str):
+        for key in [k for k in self._entries if k[0] == session_id]:
+            del self._entries[key]
+    
+    def sweep(self) -> int:
+        """移除已過期的回應，回傳移除的數量"""
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if entry.expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        return len(expired)
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+# 各端點的回應快取秒數（這些資料以小時為單位變化）
+RESPONSE_CACHE_TTLS = {
+    "profile": float(os.getenv("PROFILE_CACHE_TTL", "600")),
+    "top_tracks": float(os.getenv("TOP_TRACKS_CACHE_TTL", "3600")),
+    "top_artists": float(os.getenv("TOP_ARTISTS_CACHE_TTL", "3600")),
+}
+RESPONSE_CACHE = ResponseCache()
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # 弱比較：忽略 W/ 前綴
+    return any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in candidates)
+
+def conditional_response(request: Request, entry: CachedResponse) -> Response:
+    """帶 ETag / Cache-Control 的回應；If-None-Match 相符時回傳 304
+
+    前端以 X-Session-ID header 辨識 session、網址固定不變，
+    因此瀏覽器每次都要回來驗證（no-cache），登出或換帳號後才不會沿用上一個帳號的回應
+    """
+    headers = {
+        "ETag": entry.etag,
+        "Cache-Control": "private, no-cache",
+        "Vary": "Cookie, X-Session-ID",
+    }
+    if etag_matches(request, entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+# 回應中每個圖片陣列保留的張數（Spotify 由大到小排列，前端只用第一張）；0 = 全部保留
+RESPONSE_IMAGE_LIMIT = int(os.getenv("RESPONSE_IMAGE_LIMIT", "1"))
+
+def lean_images(images: Optional[List[Dict]]) -> List[Dict]:
+    if not images:
+        return []
+    return images[:RESPONSE_IMAGE_LIMIT] if RESPONSE_IMAGE_LIMIT > 0 else images
+
+def lean_followers(followers: Optional[Dict]) -> Dict:
+    # Spotify 的 followers.href 永遠是 null，只保留 total
+    return {"total": (followers or {}).get("total")}
 
+async def fetch_profile(session: Dict) -> Optional[Dict]:
+    """取得使用者基本資料（/v1/me），失敗時回傳 None"""
+    headers = {"Authorization": f"Bearer {session['access_token']}"}
+    user_response = await spotify_request("GET", ME_URL, headers=headers, timeout=10.0, priority=PRIORITY_INTERACTIVE)
+    if user_response.status_code != 200:
+        return None
+    user_data = decode_json(user_response.content)
+    if session.get("user_id") != user_data.get("id"):
+        session["user_id"] = user_data.get("id")
+        save_session(session)
+    return {
+        "display_name": user_data.get("display_name"),
+        "country": user_data.get("country"),
+        "followers": lean_followers(user_data.get("followers")),
+        "images": lean_images(user_data.get("images"))
+    }
+
+async def fetch_top_tracks(session: Dict, time_range: str) -> Dict:
     url = "https://api.spotify.com/v1/me/top/tracks"
-    headers = {"Authorization": f"Bearer {access_token}"}
+    headers = {"Authorization": f"Bearer {session['access_token']}"}
     params = {"time_range": time_range, "limit": 20}
 
-    async with httpx.AsyncClient(timeout=15.0) as client:
-        r = await client.get(url, headers=headers, params=params)
+    r = await spotify_request("GET", url, headers=headers, params=params, timeout=15.0, priority=PRIORITY_INTERACTIVE)
     if r.status_code != 200:
         raise HTTPException(status_code=r.status_code, detail="failed to fetch top tracks")
 
-    data = r.json()
+    data = decode_json(r.content)
     results = []
-    
+
     for item in data.get("items", []):
         results.append({
             "name": item["name"],
             "artists": [{"name": a["name"]} for a in item["artists"]],
             "album": {
                 "name": item["album"]["name"],
-                "images": item["album"].get("images", [])
+                "images": lean_images(item["album"].get("images"))
             },
             "popularity": item.get("popularity"),
             "duration_ms": item.get("duration_ms"),
@@ -594,25 +3310,16 @@ async def top_tracks(request: Request, time_range: str = Query("medium_term", re
     
     return {"time_range": time_range, "top_tracks": results}
 
-@app.get("/api/top-artists")
-async def top_artists(request: Request, time_range: str = Query("medium_term", regex="^(short_term|medium_term|long_term)$")):
-    session_id = get_session_id(request)
-    if not session_id or session_id not in SESSIONS:
-        return JSONResponse({"error": "not_logged_in"}, status_code=401)
-    session = SESSIONS[session_id]
-    await refresh_token_if_needed(session)
-    access_token = session["access_token"]
-
+async def fetch_top_artists(session: Dict, time_range: str) -> Dict:
     url = "https://api.spotify.com/v1/me/top/artists"
-    headers = {"Authorization": f"Bearer {access_token}"}
+    headers = {"Authorization": f"Bearer {session['access_token']}"}
     params = {"time_range": time_range, "limit": 20}
 
-    async with httpx.AsyncClient(timeout=15.0) as client:
-        r = await client.get(url, headers=headers, params=params)
+    r = await spotify_request("GET", url, headers=headers, params=params, timeout=15.0, priority=PRIORITY_INTERACTIVE)
     if r.status_code != 200:
         raise HTTPException(status_code=r.status_code, detail="failed to fetch top artists")
 
-    data = r.json()
+    data = decode_json(r.content)
     # 回傳詳細資料，包含更多藝人資訊
     results = []
     for item in data.get("items", []):
@@ -622,9 +3329,194 @@ async def top_artists(request: Request, time_range: str = Query("medium_term", r
             "popularity": item.get("popularity"),  # 流行度 (0-100)
             "id": item["id"],
             "external_urls": item.get("external_urls", {}),
-            "images": item.get("images", []),  # ✅ Include artist images!
-            "followers": item.get("followers", {}),  # ✅ Include follower count!
+            "images": lean_images(item.get("images")),  # ✅ Include artist images!
+            "followers": lean_followers(item.get("followers")),  # ✅ Include follower count!
             # 注意：Spotify API 不提供藝人的總播放時長資料
             # 這個資料只有 Spotify 內部才有
         })
-    return {"time_range": time_range, "top_artists": results}
\ No newline at end of file
+    return {"time_range": time_range, "top_artists": results}
+
+@app.get("/api/status")
+async def login_status(request: Request):
+    """檢查用戶登入狀態的輕量級端點"""
+    session_id, session = get_session(request)
+    
+    if session is None:
+        return JSONResponse({"logged_in": False}, status_code=200)
+    
+    # 檢查 token 是否還有效（背景已續期時不會等待）
+    try:
+        await TOKEN_MANAGER.ensure_fresh(session)
+    except HTTPException as e:
+        if e.status_code != 401:
+            raise
+        # refresh token 已失效，清除無效 session
+        drop_session(session_id)
+        return JSONResponse({"logged_in": False}, status_code=200)
+    
+    # 獲取用戶基本資料
+    try:
+        entry = await cached_profile(session_id, session)
+        if entry is not None:
+            return conditional_response(request, entry)
+    except Exception as e:
+        logger.warning("failed to fetch user profile", extra={"error": str(e)})
+    
+    return JSONResponse({"logged_in": True}, status_code=200)
+
+def cache_stats_snapshot() -> Dict[str, Dict]:
+    return {
+        "artist_genres": ARTIST_GENRE_CACHE.stats(),
+        "audio_features": AUDIO_FEATURE_CACHE.stats(),
+        "analysis_results": ANALYSIS_FLIGHTS.stats(),
+        "responses": RESPONSE_CACHE.stats(),
+    }
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """回傳快取的命中 / 未命中統計"""
+    return cache_stats_snapshot()
+
+class CacheStatsCollector:
+    """在抓取 /metrics 時才讀取各快取的計數器"""
+    
+    def collect(self):
+        hits = CounterMetricFamily("cache_hits", "Cache lookups served from cache", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Cache lookups that missed", labels=["cache"])
+        ratio = GaugeMetricFamily("cache_hit_ratio", "Cache hit ratio since process start", labels=["cache"])
+        for name, stats in cache_stats_snapshot().items():
+            hits.add_metric([name], stats["hits"] + stats.get("joined", 0))
+            misses.add_metric([name], stats["misses"])
+            ratio.add_metric([name], stats["hit_ratio"])
+        yield hits
+        yield misses
+        yield ratio
+
+REGISTRY.register(CacheStatsCollector())
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 格式的指標"""
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # 多 worker：彙整所有程序寫入的指標檔
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/logout")
+async def logout(response: Response):
+    response = RedirectResponse("/")
+    response.delete_cookie("session_id")
+    return response
+
+TIME_RANGES = ("short_term", "medium_term", "long_term")
+TOP_LIST_FETCHERS = {"top_tracks": fetch_top_tracks, "top_artists": fetch_top_artists}
+
+async def cached_top_list(session_id: str, session: Dict, kind: str, time_range: str) -> CachedResponse:
+    """取得 top tracks / top artists 的快取回應，未命中時向 Spotify 抓取（呼叫端負責刷新 token）"""
+    cache_key = (session_id, kind, time_range)
+    entry = RESPONSE_CACHE.get(cache_key)
+    if entry is None:
+        payload = await TOP_LIST_FETCHERS[kind](session, time_range)
+        entry = RESPONSE_CACHE.put(cache_key, payload, RESPONSE_CACHE_TTLS[kind])
+    return entry
+
+async def cached_profile(session_id: str, session: Dict) -> Optional[CachedResponse]:
+    """/api/status 的快取回應；取不到使用者資料時回傳 None"""
+    cache_key = (session_id, "profile")
+    entry = RESPONSE_CACHE.get(cache_key)
+    if entry is None:
+        user = await fetch_profile(session)
+        if user is None:
+            return None
+        entry = RESPONSE_CACHE.put(cache_key, {"logged_in": True, "user": user}, RESPONSE_CACHE_TTLS["profile"])
+    return entry
+
+@app.get("/api/top-tracks")
+async def top_tracks(request: Request, time_range: str = Query("medium_term", regex="^(short_term|medium_term|long_term)$")):
+    session_id, session = get_session(request)
+    if session is None:
+        return JSONResponse({"error": "not_logged_in"}, status_code=401)
+    
+    await TOKEN_MANAGER.ensure_fresh(session)
+    return conditional_response(request, await cached_top_list(session_id, session, "top_tracks", time_range))
+
+@app.get("/api/top-artists")
+async def top_artists(request: Request, time_range: str = Query("medium_term", regex="^(short_term|medium_term|long_term)$")):
+    session_id, session = get_session(request)
+    if session is None:
+        return JSONResponse({"error": "not_logged_in"}, status_code=401)
+    
+    await TOKEN_MANAGER.ensure_fresh(session)
+    return conditional_response(request, await cached_top_list(session_id, session, "top_artists", time_range))
+
+DASHBOARD_SECTIONS = ("status", "analysis", "top_tracks", "top_artists")
+
+@app.get("/api/dashboard")
+async def dashboard(request: Request, include: str = Query(",".join(DASHBOARD_SECTIONS))):
+    """一次取得儀表板需要的所有資料，取代前端依序呼叫 status / analysis / 六個 top 清單
+    
+    token 只檢查一次，各區塊在伺服器端並行抓取。每個區塊的內容與對應端點的回應相同
+    （top_tracks / top_artists 依 time_range 分組），直接拼接已序列化的快取內容，不重新編碼。
+    單一區塊失敗時該區塊為 null，錯誤記錄在 errors 中，其餘區塊照常回傳。
+    """
+    sections = [name.strip() for name in include.split(",") if name.strip()]
+    unknown = [name for name in sections if name not in DASHBOARD_SECTIONS]
+    if unknown or not sections:
+        raise HTTPException(status_code=400, detail=f"include must be a subset of {','.join(DASHBOARD_SECTIONS)}")
+    
+    session_id, session = get_session(request)
+    if session is None:
+        return JSONResponse({"error": "not_logged_in"}, status_code=401)
+    try:
+        await TOKEN_MANAGER.ensure_fresh(session)
+    except HTTPException as e:
+        if e.status_code != 401:
+            raise
+        drop_session(session_id)
+        return JSONResponse({"error": "not_logged_in"}, status_code=401)
+    
+    async def status_body() -> bytes:
+        entry = await cached_profile(session_id, session)
+        return entry.body if entry is not None else b'{"logged_in":true}'
+    
+    async def analysis_body() -> bytes:
+        return encode_json(await get_analysis(session_id, session))
+    
+    async def top_list_body(kind: str, time_range: str) -> bytes:
+        return (await cached_top_list(session_id, session, kind, time_range)).body
+    
+    jobs: Dict[Tuple[str, Optional[str]], Awaitable[bytes]] = {}
+    for name in dict.fromkeys(sections):
+        if name == "status":
+            jobs[(name, None)] = status_body()
+        elif name == "analysis":
+            jobs[(name, None)] = analysis_body()
+        else:
+            for time_range in TIME_RANGES:
+                jobs[(name, time_range)] = top_list_body(name, time_range)
+    bodies = await asyncio.gather(*jobs.values(), return_exceptions=True)
+    
+    parts: Dict[str, List[bytes]] = {}
+    errors: Dict[str, Dict] = {}
+    for (name, time_range), body in zip(jobs, bodies):
+        label = f"{name}.{time_range}" if time_range else name
+        if isinstance(body, BaseException):
+            if isinstance(body, HTTPException):
+                errors[label] = {"status": body.status_code, "detail": body.detail}
+            else:
+                logger.warning("dashboard section failed", extra={"section": label, "error_type": type(body).__name__})
+                errors[label] = {"status": 500, "detail": "internal error"}
+            body = b"null"
+        if time_range:
+            body = b'"' + time_range.encode() + b'":' + body
+        parts.setdefault(name, []).append(body)
+    
+    fields = [
+        b'"' + name.encode() + b'":' + (b"{" + b",".join(chunks) + b"}" if name in TOP_LIST_FETCHERS else chunks[0])
+        for name, chunks in parts.items()
+    ]
+    fields.append(b'"errors":' + encode_json(errors))
+    return Response(content=b"{" + b",".join(fields) + b"}", media_type="application/json")
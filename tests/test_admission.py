@@ -0,0 +1,111 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "test-client")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "test-secret")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException
+
+import main
+
+
+def controller(max_concurrent=1, per_user=1, max_queue=4, queue_timeout=5.0):
+    return main.AdmissionController(max_concurrent, per_user, max_queue, queue_timeout, retry_after=7)
+
+
+def test_full_queue_rejects_with_retry_after():
+    async def run():
+        admission = controller(max_queue=1)
+        await admission.acquire("a")
+        waiter = asyncio.create_task(admission.acquire("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as rejected:
+            await admission.acquire("c")
+        with pytest.raises(HTTPException):
+            admission.check("c")
+        admission.release("a")
+        await waiter
+        return rejected.value, admission.active
+
+    error, active = asyncio.run(run())
+    assert error.status_code == 503
+    assert error.headers == {"Retry-After": "7"}
+    assert active == 1
+
+
+def test_user_at_cap_is_skipped_for_the_next_user():
+    async def run():
+        admission = controller(max_concurrent=2)
+        await admission.acquire("a")
+        await admission.acquire("b")
+        second_a = asyncio.create_task(admission.acquire("a"))
+        await asyncio.sleep(0)
+        c = asyncio.create_task(admission.acquire("c"))
+        await asyncio.sleep(0)
+        # b 完成後空出的名額給 c；a 仍在自己的上限內，繼續排隊
+        admission.release("b")
+        await c
+        queued = second_a.done()
+        admission.release("a")
+        await second_a
+        return queued, admission.active
+
+    queued, active = asyncio.run(run())
+    assert queued is False
+    assert active == 2
+
+
+def test_queue_timeout_rejects_and_leaves_the_queue():
+    async def run():
+        admission = controller(queue_timeout=0.05)
+        await admission.acquire("a")
+        with pytest.raises(HTTPException) as rejected:
+            await admission.acquire("b")
+        admission.release("a")
+        await admission.acquire("c")
+        return rejected.value, admission.active, len(admission._waiters)
+
+    error, active, waiting = asyncio.run(run())
+    assert error.status_code == 503
+    assert active == 1
+    assert waiting == 0
+
+
+def test_cancelled_after_admission_releases_to_next_waiter():
+    async def run():
+        admission = controller()
+        await admission.acquire("a")
+        b = asyncio.create_task(admission.acquire("b"))
+        await asyncio.sleep(0)
+        c = asyncio.create_task(admission.acquire("c"))
+        await asyncio.sleep(0)
+        # b 已被分配名額，但在恢復執行前就被取消（例如客戶端斷線）
+        admission.release("a")
+        b.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await b
+        await asyncio.wait_for(c, 1)
+        return admission.active, dict(admission._active_by_user)
+
+    active, by_user = asyncio.run(run())
+    assert active == 1
+    assert by_user == {"c": 1}
+
+
+def test_cancelled_while_queued_does_not_take_a_slot():
+    async def run():
+        admission = controller()
+        await admission.acquire("a")
+        b = asyncio.create_task(admission.acquire("b"))
+        await asyncio.sleep(0)
+        b.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await b
+        admission.release("a")
+        return admission.active, len(admission._waiters)
+
+    assert asyncio.run(run()) == (0, 0)
@@ -0,0 +1,29 @@
+import os
+import sys
+
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "test-client")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "test-secret")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def test_ties_do_not_depend_on_arrival_order():
+    """增量同步把新藝人排在最後；同次數的 genre 與分類排序要與完整同步相同"""
+    artist_genres = {
+        "a1": ["zouk", "jazz"],
+        "a2": ["jazz", "zouk"],
+        "a3": ["indie rock"],
+        "a4": ["ambient", "indie rock"],
+        "a5": ["ambient"],
+    }
+    full = main.GenreAggregator()
+    full.add_artists({aid: artist_genres[aid] for aid in ("a5", "a4", "a3", "a2", "a1")})
+    incremental = main.GenreAggregator()
+    incremental.add_artists({aid: artist_genres[aid] for aid in ("a3", "a1")})
+    incremental.add_artists({aid: artist_genres[aid] for aid in ("a5", "a4", "a2")})
+
+    assert incremental.top_genres() == full.top_genres()
+    assert full.top_genres() == [("ambient", 2), ("indie rock", 2), ("jazz", 2), ("zouk", 2)]
+    assert list(incremental.bucket_counts().items()) == list(full.bucket_counts().items())
+    assert incremental.genre_graph() == full.genre_graph()
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "test-client")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "test-secret")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def test_interactive_requests_jump_the_bulk_queue():
+    order = []
+
+    async def run():
+        scheduler = main.RateLimitScheduler(rate=100, burst=1)
+        await scheduler.acquire()
+
+        async def request(name, priority):
+            await scheduler.acquire(priority)
+            order.append(name)
+
+        tasks = [asyncio.create_task(request("bulk-1", main.PRIORITY_BULK))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request("bulk-2", main.PRIORITY_BULK)))
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request("interactive", main.PRIORITY_INTERACTIVE)))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["interactive", "bulk-1", "bulk-2"]
+
+
+def test_pause_holds_every_priority_until_retry_after():
+    async def run():
+        scheduler = main.RateLimitScheduler(rate=1000, burst=10)
+        scheduler.pause(0.2)
+        started = time.monotonic()
+        assert scheduler.try_acquire() is False
+        await asyncio.gather(scheduler.acquire(main.PRIORITY_INTERACTIVE), scheduler.acquire())
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) >= 0.2
+
+
+def test_cancelled_waiter_returns_its_token():
+    async def run():
+        scheduler = main.RateLimitScheduler(rate=1, burst=1)
+        await scheduler.acquire()
+        first = asyncio.create_task(scheduler.acquire())
+        second = asyncio.create_task(scheduler.acquire())
+        await asyncio.sleep(0)
+        # 補充一個 token 交給 first，但 first 在恢復執行前就被取消
+        scheduler.tokens = 1
+        scheduler._dispatch()
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        # 歸還的 token 立即交給 second，而不是等下一秒補充
+        await asyncio.wait_for(second, 0.1)
+        return scheduler.stats()["waiting"]
+
+    assert asyncio.run(run()) == 0
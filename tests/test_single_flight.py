@@ -0,0 +1,46 @@
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "test-client")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "test-secret")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def test_stale_results_are_not_cached():
+    """熔斷時的 stale 結果只交給當下的呼叫者，恢復後的下一次請求要重新計算"""
+    results = [{"total_tracks": 1, "stale": True}, {"total_tracks": 2}]
+
+    async def run():
+        flights = main.SingleFlight(ttl=300, cacheable=lambda result: not result.get("stale"))
+
+        async def factory():
+            return results.pop(0)
+
+        first = await flights.run("user:a", factory)
+        second = await flights.run("user:a", factory)
+        third = await flights.run("user:a", factory)
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert first["stale"] is True
+    assert second == {"total_tracks": 2}
+    assert third is second
+
+
+def test_sweep_drops_expired_results():
+    async def run():
+        flights = main.SingleFlight(ttl=300)
+
+        async def factory():
+            return {"total_tracks": 1}
+
+        await flights.run("user:a", factory)
+        await flights.run("user:b", factory)
+        flights._results["user:a"] = (time.time() - 1, flights._results["user:a"][1])
+        return flights.sweep(), flights.stats()["size"]
+
+    assert asyncio.run(run()) == (1, 1)
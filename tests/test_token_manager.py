@@ -0,0 +1,73 @@
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "test-client")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "test-secret")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+import main
+
+
+def install_token_endpoint(posts):
+    async def handler(request):
+        posts.append(request)
+        return httpx.Response(200, json={"access_token": f"tok{len(posts)}", "expires_in": 3600})
+
+    main.HTTP_CLIENT = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def refresh_count(outcome):
+    return main.TOKEN_REFRESHES.labels(outcome)._value.get()
+
+
+def test_background_refresh_posts_once_before_expiry():
+    """計時器在 margin 之前觸發時也要真的刷新，而不是每次沿用舊 token 立即重排"""
+    posts = []
+
+    async def run():
+        install_token_endpoint(posts)
+        manager = main.TokenManager(margin=1.0, jitter=0.5, keepalive=60)
+        session = {"id": "bg", "access_token": "old", "refresh_token": "r", "expires_at": time.time() + 2.0}
+        main.SESSION_STORE.save("bg", session)
+        fired = 0
+        on_timer = manager._on_timer
+
+        def counting_on_timer(session_id):
+            nonlocal fired
+            fired += 1
+            on_timer(session_id)
+
+        manager._on_timer = counting_on_timer
+        manager.track(session)
+        await asyncio.sleep(1.6)
+        manager.close()
+        return fired, main.SESSION_STORE.get("bg")
+
+    fired, stored = asyncio.run(run())
+    assert len(posts) == 1
+    assert fired == 1
+    assert stored["access_token"] == "tok1"
+    assert stored["expires_at"] > time.time() + 3000
+
+
+def test_refresh_reuses_tokens_refreshed_by_another_worker():
+    posts = []
+
+    async def run():
+        install_token_endpoint(posts)
+        manager = main.TokenManager(margin=300, jitter=0, keepalive=60)
+        stale = {"id": "shared", "access_token": "old", "refresh_token": "r", "expires_at": time.time() + 10}
+        main.SESSION_STORE.save("shared", {**stale, "access_token": "fresh", "expires_at": time.time() + 3600})
+        reused_before = refresh_count("reused")
+        await manager.refresh(stale)
+        manager.close()
+        return stale, refresh_count("reused") - reused_before
+
+    session, reused = asyncio.run(run())
+    assert posts == []
+    assert session["access_token"] == "fresh"
+    assert reused == 1
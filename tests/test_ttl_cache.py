@@ -0,0 +1,29 @@
+import os
+import sys
+import time
+
+os.environ.setdefault("SPOTIFY_CLIENT_ID", "test-client")
+os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "test-secret")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def db_keys(cache):
+    return {key for (key,) in cache._db.execute(f"SELECT key FROM {cache.name}")}
+
+
+def test_sweep_prunes_expired_rows_and_caps_row_count(tmp_path):
+    cache = main.TTLCache("sweep_test", maxsize=10, ttl=60, db_path=str(tmp_path / "cache.db"), db_max_rows=3)
+    cache.set_many({"expired": 1})
+    cache._db.execute("UPDATE sweep_test SET expires_at = ?", (time.time() - 1,))
+    for i in range(4):
+        cache.set_many({f"k{i}": i})
+        time.sleep(0.01)
+
+    assert cache.sweep() == 2
+    assert db_keys(cache) == {"k1", "k2", "k3"}
+    # SQLite 的清理有最短間隔，記憶體層則每次都清
+    cache.set_many({"k4": 4})
+    assert cache.sweep() == 0
+    assert len(db_keys(cache)) == 4